@@ -0,0 +1,302 @@
+from collections.abc import MutableMapping
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from cashaddress.convert import Address, InvalidAddress
+
+PREFIX = 'bitcoincash'
+CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+# cashaddr characters mapped onto the digits int(..., 32) understands, anything else onto an invalid digit
+_FROM_BASE32 = bytes(ord('0123456789abcdefghijklmnopqrstuv'[CHARSET.index(chr(byte))]) if chr(byte) in CHARSET
+                     else ord('z') for byte in range(256))
+_GENERATORS = (0x98f2bc8e61, 0x79b76d99e2, 0xf33e5fb3c4, 0xae2eabe2a8, 0x1e4f43e470)
+_VERSIONS = {'P2PKH': 0, 'P2SH': 8, 'P2PKH-TESTNET': 0, 'P2SH-TESTNET': 8}
+# generator terms for every value of the top five checksum bits, so each step is one lookup
+_POLYMOD_TABLE = [0] * 32
+for _top in range(32):
+    for _i, _generator in enumerate(_GENERATORS):
+        if (_top >> _i) & 1:
+            _POLYMOD_TABLE[_top] ^= _generator
+
+
+def _polymod(values: Iterable[int], checksum: int = 1) -> int:
+    for value in values:
+        checksum = ((checksum & 0x07ffffffff) << 5) ^ value ^ _POLYMOD_TABLE[checksum >> 35]
+    return checksum
+
+
+def _checksum_tables():
+    # the checksum is linear in the payload bits, so it is a constant xor one table entry per key byte
+    def payload_checksum(key):
+        payload = int.from_bytes(key, 'big') << 2
+        data = [(payload >> shift) & 31 for shift in range(165, -1, -5)]
+        return _polymod(data + [0] * 8, _polymod([ord(char) & 31 for char in PREFIX] + [0]))
+
+    empty = payload_checksum(bytes(21))
+    tables = []
+    for position in range(21):
+        table = [0] * 256
+        for bit in range(8):
+            key = bytearray(21)
+            key[position] = 1 << bit
+            term = payload_checksum(key) ^ empty
+            for byte in range(1 << bit, 2 << bit):
+                table[byte] = table[byte - (1 << bit)] ^ term
+        tables.append(table)
+    return empty ^ 1, tables
+
+
+_CHECKSUM_BASE, _CHECKSUM_TABLES = _checksum_tables()
+_CHAR_PAIRS = [CHARSET[pair >> 5] + CHARSET[pair & 31] for pair in range(1024)]
+# zero characters around each address in raw_keys, so an address and its checksum take a whole 35 bytes
+_BATCH_PAD = 'q' * 14
+_BATCH_STRIDE = 35
+# stands in for an address of the wrong length: zero padding bits but an invalid version byte
+_BATCH_INVALID = 'l' + 'q' * 41
+
+
+def raw_key(base_addr: str) -> Optional[bytes]:
+    """
+    Key of a prefix-less cashaddr as it appears in Bitsocket's out.e.a: the version byte followed
+    by the 20-byte hash. The checksum is not verified; None if it isn't a 160-bit address.
+    """
+    if len(base_addr) != 42:
+        return None
+    try:
+        payload = int(base_addr[:34].encode('ascii').translate(_FROM_BASE32), 32)
+    except (UnicodeEncodeError, ValueError):
+        return None
+    if payload & 3 or payload >> 162 not in (0, 8):
+        return None
+    return (payload >> 2).to_bytes(21, 'big')
+
+
+def raw_keys(base_addrs: List[str]) -> List[Optional[bytes]]:
+    """
+    raw_key of many addresses, decoded together as one base32 number, which takes about half
+    as long as decoding them one by one.
+    """
+    if set(map(len, base_addrs)) - {42}:
+        base_addrs = [base_addr if len(base_addr) == 42 else _BATCH_INVALID for base_addr in base_addrs]
+    # a trailing empty address takes the padding and checksum of the last one after the shift below
+    text = _BATCH_PAD + _BATCH_PAD.join(base_addrs) + _BATCH_PAD + 'q' * 42
+    try:
+        value = int(text.encode('ascii').translate(_FROM_BASE32), 32)
+    except (UnicodeEncodeError, ValueError):
+        return [raw_key(base_addr) for base_addr in base_addrs]
+    # shifted so each key ends on a byte boundary; the padding bits and checksum of an address
+    # land in the first bytes of the next one, the padding bits in the top two bits
+    data = (value >> 42).to_bytes(_BATCH_STRIDE * (len(base_addrs) + 1), 'big')
+    end = _BATCH_STRIDE * len(base_addrs)
+    keys = [data[start:start + 21] for start in range(_BATCH_STRIDE - 21, end, _BATCH_STRIDE)]
+    padding = data[_BATCH_STRIDE::_BATCH_STRIDE]
+    versions = data[_BATCH_STRIDE - 21:end:_BATCH_STRIDE]
+    if padding.translate(None, bytes(range(64))) or versions.translate(None, b'\x00\x08'):
+        for i in range(len(base_addrs)):
+            if padding[i] >= 64 or versions[i] not in (0, 8):
+                keys[i] = None
+    return keys
+
+
+def key_for_address(address: Address) -> Optional[bytes]:
+    if len(address.payload) != 20 or address.version not in _VERSIONS:
+        return None
+    return bytes([_VERSIONS[address.version], *address.payload])
+
+
+def address_key(address: str) -> Optional[bytes]:
+    """
+    Key of a cashaddr or legacy address string, None unless its checksum matches; testnet
+    addresses map onto the mainnet key.
+    """
+    if address.startswith(PREFIX + ':'):
+        base_addr = address[len(PREFIX) + 1:]
+        key = raw_key(base_addr)
+        if key is not None:
+            # raw_key already checked the characters of the payload, the checksum ones may still be invalid
+            try:
+                checksum = int(base_addr[34:].encode('ascii').translate(_FROM_BASE32), 32)
+            except ValueError:
+                return None
+            return key if checksum == _checksum(key) else None
+    try:
+        return key_for_address(Address.from_string(address))
+    except Exception:
+        return None
+
+
+def _checksum(key: bytes) -> int:
+    checksum = _CHECKSUM_BASE
+    for table, byte in zip(_CHECKSUM_TABLES, key):
+        checksum ^= table[byte]
+    return checksum
+
+
+def raw_address(key: bytes) -> str:
+    payload = int.from_bytes(key, 'big') << 42 | _checksum(key)
+    return ''.join([_CHAR_PAIRS[(payload >> shift) & 1023] for shift in range(200, -1, -10)])
+
+
+def cash_address(key: bytes) -> str:
+    return PREFIX + ':' + raw_address(key)
+
+
+class AddressRegistry(MutableMapping):
+    """
+    Subscriber records keyed by address. Each address is held once as its 21-byte key and each
+    distinct record once, interned to a small id; records are shared and must be replaced,
+    not mutated. Iterating yields canonical cashaddrs.
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[bytes, int] = {}
+        self._records = []
+        self._record_refs = []
+        self._record_ids = {}
+        self._free_record_ids = []
+
+    def _intern(self, record: Dict) -> int:
+        signature = tuple(sorted(record.items()))
+        record_id = self._record_ids.get(signature)
+        if record_id is None:
+            record = dict(record)
+            if self._free_record_ids:
+                record_id = self._free_record_ids.pop()
+                self._records[record_id] = record
+                self._record_refs[record_id] = 0
+            else:
+                record_id = len(self._records)
+                self._records.append(record)
+                self._record_refs.append(0)
+            self._record_ids[signature] = record_id
+        self._record_refs[record_id] += 1
+        return record_id
+
+    def _release(self, record_id: int) -> None:
+        self._record_refs[record_id] -= 1
+        if self._record_refs[record_id] == 0:
+            del self._record_ids[tuple(sorted(self._records[record_id].items()))]
+            self._records[record_id] = None
+            self._free_record_ids.append(record_id)
+
+    def set_key(self, key: bytes, record: Dict) -> None:
+        record_id = self._intern(record)
+        old_record_id = self._entries.get(key)
+        self._entries[key] = record_id
+        if old_record_id is not None:
+            self._release(old_record_id)
+
+    def load(self, records: Dict[str, Dict]) -> List[str]:
+        """
+        Adds records read back from the store and returns the addresses that couldn't be decoded.
+        Their checksums were verified when they were subscribed, so cashaddrs are decoded in one
+        raw_keys batch without checking them again.
+        """
+        addresses = list(records)
+        prefix = PREFIX + ':'
+        keys = raw_keys([address[len(prefix):] if address.startswith(prefix) else '' for address in addresses])
+        invalid = []
+        for address, key in zip(addresses, keys):
+            if key is None:
+                key = address_key(address)
+                if key is None:
+                    invalid.append(address)
+                    continue
+            self.set_key(key, records[address])
+        return invalid
+
+    def get_key(self, key: bytes) -> Optional[Dict]:
+        record_id = self._entries.get(key)
+        return self._records[record_id] if record_id is not None else None
+
+    def has_key(self, key: bytes) -> bool:
+        return key in self._entries
+
+    def keys_raw(self) -> Iterator[bytes]:
+        return iter(self._entries)
+
+    def distinct_records(self) -> Iterator[Dict]:
+        return (record for record in self._records if record is not None)
+
+    def __setitem__(self, address: str, record: Dict) -> None:
+        key = address_key(address)
+        if key is None:
+            raise InvalidAddress(f'Invalid address: {address}')
+        self.set_key(key, record)
+
+    def __getitem__(self, address: str) -> Dict:
+        key = address_key(address)
+        if key is None or key not in self._entries:
+            raise KeyError(address)
+        return self._records[self._entries[key]]
+
+    def __delitem__(self, address: str) -> None:
+        key = address_key(address)
+        if key is None or key not in self._entries:
+            raise KeyError(address)
+        self._release(self._entries.pop(key))
+
+    def __contains__(self, address) -> bool:
+        key = address_key(address) if isinstance(address, str) else None
+        return key is not None and key in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return map(cash_address, self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _test():
+    addresses = [
+        'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4',
+        'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l',
+    ]
+    for address in addresses:
+        decoded = Address.from_string(address)
+        key = address_key(address)
+        assert key == key_for_address(decoded)
+        assert cash_address(key) == address
+        assert address_key(decoded.legacy_address()) == key
+        assert address_key(address.upper()) == key
+        assert raw_key(address.split(':')[1]) == key
+    assert raw_key('qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh') is None
+    assert raw_key('Qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4') is None
+    assert raw_key('bz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4') is None
+    assert address_key('bitcoincash:not-an-address') is None
+    # a typo anywhere, or a payload padded out with zeros, fails the checksum
+    assert address_key('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh5') is None
+    assert address_key('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusrqqqqqqq') is None
+    assert address_key('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnhb') is None
+    base_addrs = [address.split(':')[1] for address in addresses]
+    batch = [base_addrs[0], 'short', base_addrs[1], 'qz4v8lrnv786e42n7xg0czpelp439aytusray7cnhl',
+             'zz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4', base_addrs[0]]
+    assert raw_keys(batch) == [raw_key(base_addr) for base_addr in batch]
+    assert raw_keys(batch[:3] + ['Qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4']) == [raw_keys(batch)[0], None,
+                                                                                    raw_keys(batch)[2], None]
+    assert raw_keys([]) == []
+
+    registry = AddressRegistry()
+    registry[addresses[0]] = {'currency': 'USD'}
+    registry[Address.from_string(addresses[1]).legacy_address()] = {'currency': 'USD'}
+    assert registry[addresses[0]] is registry[addresses[1]]
+    assert sorted(registry) == sorted(addresses)
+    registry[addresses[0]] = {'currency': 'EUR'}
+    assert registry.get(addresses[0]) == {'currency': 'EUR'}
+    assert registry.get_key(raw_key(addresses[1].split(':')[1])) == {'currency': 'USD'}
+    del registry[addresses[1]]
+    assert addresses[1] not in registry and len(registry) == 1
+    assert list(registry.distinct_records()) == [{'currency': 'EUR'}]
+    loaded = AddressRegistry()
+    assert loaded.load({addresses[0]: {'currency': 'USD'}, Address.from_string(addresses[1]).legacy_address():
+                        {'currency': 'EUR'}, 'bitcoincash:short': {'currency': 'USD'}}) == ['bitcoincash:short']
+    assert loaded.get(addresses[0]) == {'currency': 'USD'} and loaded.get(addresses[1]) == {'currency': 'EUR'}
+    try:
+        registry['invalid'] = {'currency': 'USD'}
+    except InvalidAddress:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import zlib
+from abc import ABCMeta, abstractmethod
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# snapshot written by compaction: addresses grouped by identical record, so loading is one
+# dict.fromkeys per group; records loaded this way are shared and must be replaced, not mutated
+SNAPSHOT_MARKER = 'notifybch-addresses'
+SNAPSHOT_FORMAT = 2
+# each log record is framed with its length and crc32, so a torn write at the end is recognized
+_FRAME = struct.Struct('<II')
+
+logger = logging.getLogger(__name__)
+
+
+class AddressStore(metaclass=ABCMeta):
+    @abstractmethod
+    def load(self, repair: bool = True) -> Dict[str, Dict]:
+        """Only the process that writes may repair the store; any other one just reads it."""
+        pass
+
+    @abstractmethod
+    async def save(self, address: str, record: Dict) -> None:
+        pass
+
+    @abstractmethod
+    async def remove(self, address: str) -> None:
+        pass
+
+    @abstractmethod
+    async def save_many(self, records: Dict[str, Dict]) -> None:
+        pass
+
+    @abstractmethod
+    async def remove_many(self, addresses: Iterable[str]) -> None:
+        pass
+
+
+class AddressStoreLog(AddressStore):
+    """
+    Snapshot plus an append-only log of changed records, folded back into the snapshot
+    every compact_every records. Legacy addresses.pickle files (a dict or a set) load as well.
+    """
+
+    def __init__(self, path: str, compact_every: int = 10_000) -> None:
+        self._path = path
+        self._log_path = path + '.log'
+        self._compact_every = compact_every
+        self._log_records = 0
+        self._executor = ThreadPoolExecutor(1)
+
+    def load(self, repair: bool = True) -> Dict[str, Dict]:
+        while True:
+            snapshot_id = self._snapshot_id()
+            addresses = self._read_snapshot()
+            log_records, good_end = self._replay_log(addresses)
+            # a compaction in between replaced the snapshot and removed the log that went with it
+            if self._snapshot_id() == snapshot_id:
+                break
+        if not repair:
+            return addresses
+        self._log_records = log_records
+        try:
+            size = os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            size = 0
+        if size > good_end:
+            # later records are appended after the last intact one instead of after the torn bytes
+            logger.warning('dropping %d bytes of torn records at the end of %s', size - good_end, self._log_path)
+            with open(self._log_path, 'r+b') as f:
+                f.truncate(good_end)
+        return addresses
+
+    def _snapshot_id(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    async def save(self, address: str, record: Dict) -> None:
+        await self._submit(address, dict(record))
+
+    async def remove(self, address: str) -> None:
+        await self._submit(address, None)
+
+    async def save_many(self, records: Dict[str, Dict]) -> None:
+        await self._submit_many([(address, dict(record)) for address, record in records.items()])
+
+    async def remove_many(self, addresses: Iterable[str]) -> None:
+        await self._submit_many([(address, None) for address in addresses])
+
+    async def _submit(self, address: str, record: Optional[Dict]) -> None:
+        await self._submit_many([(address, record)])
+
+    async def _submit_many(self, changes: List[Tuple[str, Optional[Dict]]]) -> None:
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._append, changes)
+
+    def _read_snapshot(self) -> Dict[str, Dict]:
+        try:
+            with open(self._path, 'rb') as f:
+                addresses = pickle.load(f)
+        except FileNotFoundError:
+            return dict()
+        if isinstance(addresses, tuple) and addresses[:2] == (SNAPSHOT_MARKER, SNAPSHOT_FORMAT):
+            snapshot = {}
+            for record, group in addresses[2]:
+                snapshot.update(dict.fromkeys(group, record))
+            return snapshot
+        if isinstance(addresses, set):
+            return dict.fromkeys(addresses, {'currency': 'USD'})
+        return addresses
+
+    @staticmethod
+    def _encode_snapshot(addresses: Dict[str, Dict]) -> tuple:
+        groups = {}
+        for address, record in addresses.items():
+            key = tuple(sorted(record.items()))
+            if key not in groups:
+                groups[key] = (record, [])
+            groups[key][1].append(address)
+        return SNAPSHOT_MARKER, SNAPSHOT_FORMAT, list(groups.values())
+
+    def _replay_log(self, addresses: Dict[str, Dict]) -> Tuple[int, int]:
+        """Number of records applied and the offset just past the last intact one."""
+        try:
+            with open(self._log_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0, 0
+        n_records = 0
+        offset = 0
+        while offset + _FRAME.size <= len(data):
+            length, checksum = _FRAME.unpack_from(data, offset)
+            payload = data[offset + _FRAME.size:offset + _FRAME.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            try:
+                address, record = pickle.loads(payload)
+            except Exception:
+                break
+            if record is None:
+                addresses.pop(address, None)
+            else:
+                addresses[address] = record
+            n_records += 1
+            offset += _FRAME.size + length
+        return n_records, offset
+
+    @staticmethod
+    def _frame(change: Tuple[str, Optional[Dict]]) -> bytes:
+        payload = pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL)
+        return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _append(self, changes: List[Tuple[str, Optional[Dict]]]) -> None:
+        with open(self._log_path, 'ab') as f:
+            f.write(b''.join(map(self._frame, changes)))
+        self._log_records += len(changes)
+        if self._log_records >= self._compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        addresses = self._read_snapshot()
+        self._replay_log(addresses)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self._encode_snapshot(addresses), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+        try:
+            os.remove(self._log_path)
+        except FileNotFoundError:
+            pass
+        self._log_records = 0
+
+
+def _test():
+    import tempfile
+
+    async def run(path):
+        with open(path, 'wb') as f:
+            pickle.dump({'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4'}, f)
+        store = AddressStoreLog(path, compact_every=3)
+        addresses = store.load()
+        assert addresses == {'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4': {'currency': 'USD'}}
+
+        await store.save('bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l', {'currency': 'EUR'})
+        await store.save('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4', {'currency': 'JPY'})
+        assert AddressStoreLog(path).load() == {
+            'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4': {'currency': 'JPY'},
+            'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l': {'currency': 'EUR'},
+        }
+
+        await store.remove('bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l')
+        assert not os.path.exists(path + '.log')
+        assert AddressStoreLog(path).load() == {
+            'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4': {'currency': 'JPY'},
+        }
+        with open(path, 'rb') as f:
+            assert pickle.load(f)[:2] == (SNAPSHOT_MARKER, SNAPSHOT_FORMAT)
+
+        await store.save_many({'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l': {'currency': 'EUR'},
+                               'bitcoincash:qraqx7hu9g8pduxktlfgyzdnma6nmkaxwsehstwwst': {'currency': 'USD'}})
+        await store.remove_many(['bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4'])
+        assert AddressStoreLog(path).load() == {
+            'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l': {'currency': 'EUR'},
+            'bitcoincash:qraqx7hu9g8pduxktlfgyzdnma6nmkaxwsehstwwst': {'currency': 'USD'},
+        }
+
+        # a crash in the middle of an append leaves a partial record, which the next load cuts off
+        with open(path + '.log', 'ab') as f:
+            f.write(store._frame(('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4', {'currency': 'JPY'}))[:-5])
+        size = os.path.getsize(path + '.log')
+        assert len(AddressStoreLog(path).load(repair=False)) == 2
+        assert os.path.getsize(path + '.log') == size
+        store = AddressStoreLog(path, compact_every=3)
+        assert len(store.load()) == 2
+        assert os.path.getsize(path + '.log') < size
+        await store.remove('bitcoincash:qraqx7hu9g8pduxktlfgyzdnma6nmkaxwsehstwwst')
+        assert AddressStoreLog(path).load() == {
+            'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l': {'currency': 'EUR'},
+        }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(os.path.join(tmp_dir, 'addresses.pickle')))
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,576 @@
+import asyncio
+import json
+import os
+import pickle
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
+
+from aiohttp import web
+from cashaddress.convert import Address
+
+import address_registry
+import address_store
+import exchange_rate
+import notifier
+import payment_history
+import pipeline
+import seen
+import text_to_speech
+import tx_event
+import wallet
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(f: Callable[[], None]) -> Callable[[], None]:
+    BENCHMARKS[f.__name__[len('bench_'):]] = f
+    return f
+
+
+def random_addresses(n: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        Address(rng.choice(['P2PKH', 'P2SH']), list(rng.getrandbits(8) for _ in range(20))).cash_address()
+        for _ in range(n)
+    ]
+
+
+def fake_base_addrs(n: int, rng: random.Random) -> List[str]:
+    # P2PKH cashaddrs encoded straight from random hashes, much cheaper than going through Address
+    return [address_registry.raw_address(bytes(1) + rng.getrandbits(160).to_bytes(20, 'big')) for _ in range(n)]
+
+
+def import_run():
+    # run.py reads its configuration from the environment and its templates from the cwd on import
+    tmp_dir = tempfile.mkdtemp()
+    os.environ.setdefault('ONESIGNAL_APP_KEY', 'benchmark')
+    os.environ.setdefault('ONESIGNAL_APP_ID', 'benchmark')
+    os.environ['ROLE'] = 'single'
+    os.environ['ADDRESSES_PATH'] = os.path.join(tmp_dir, 'addresses.pickle')
+    os.environ['SPEECH_PATH'] = os.path.join(tmp_dir, 'speech')
+    os.environ['PAYMENT_HISTORY_PATH'] = os.path.join(tmp_dir, 'payments.sqlite')
+    os.environ['EXCHANGE_RATES_PATH'] = os.path.join(tmp_dir, 'exchange_rates.pickle')
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import run
+    return run
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(name: str, n: int, seconds: float) -> None:
+    print(f'{name:<40} {n / seconds:>14,.0f} ops/s {seconds / n * 1e6:>10.2f} us/op')
+
+
+def time_n(f: Callable[[], object], n: int) -> float:
+    return min(timeit.repeat(f, number=n, repeat=3))
+
+
+@benchmark
+def bench_output_matching() -> None:
+    watching = wallet.WalletDefault()
+    watching.add_address_keys(address_registry.address_key(address) for address in random_addresses(1000))
+    tx_dict = tx_event._test_event()['data'][0]
+
+    def match_decoded():
+        amounts = {}
+        for output in tx_event.TxBitsocket(tx_dict).outputs():
+            address = output.address()
+            if address is not None and watching.is_listening_to_key(address_registry.key_for_address(address)):
+                amounts.setdefault(address.cash_address(), 0)
+                amounts[address.cash_address()] += output.amount()
+        return amounts
+
+    def match_raw():
+        amounts = {}
+        for output in tx_event.TxBitsocket(tx_dict).outputs():
+            base_addr = output.raw_address()
+            if base_addr is not None and watching.is_listening_to_key(address_registry.raw_key(base_addr)):
+                bch_address = 'bitcoincash:' + base_addr
+                amounts[bch_address] = amounts.get(bch_address, 0) + output.amount()
+        return amounts
+
+    n = 2_000
+    decoded = time_n(match_decoded, n)
+    raw = time_n(match_raw, n)
+    report('output matching, cashaddr decode', n, decoded)
+    report('output matching, raw e.a', n, raw)
+    print(f'speedup: {decoded / raw:.1f}x')
+
+
+@benchmark
+def bench_tx_parsing() -> None:
+    watching = wallet.WalletDefault()
+    watching.add_address_keys(address_registry.address_key(address) for address in random_addresses(1000))
+    event = tx_event._test_event()
+    tx_dict = event['data'][0]
+    sse_data = json.dumps({**event, 'data': [{**tx_dict, 'out': [{**output, 's1': None, 's2': None}
+                                                                 for output in tx_dict['out']]}]})
+    raw_tx = bytes.fromhex(tx_event._test_raw_tx())
+
+    def match(tx):
+        return tx.tx_hash(), [output.amount() for output in tx.outputs()
+                              if watching.is_listening_to_key(output.address_key())]
+
+    n = 20_000
+    report('TxBitsocket from dict', n, time_n(lambda: match(tx_event.TxBitsocket(tx_dict)), n))
+    report('TxBitsocket from SSE json', n,
+           time_n(lambda: match(tx_event.TxBitsocket(json.loads(sse_data)['data'][0])), n))
+    report('TxRaw from bytes', n, time_n(lambda: match(tx_event.TxRaw(raw_tx)), n))
+    print(f'SSE message {len(sse_data)} bytes, raw tx {len(raw_tx)} bytes')
+
+
+@benchmark
+def bench_format_amounts() -> None:
+    run = import_run()
+    run.exchange_rates = exchange_rate.ExchangeRateFixed()
+    n = 100_000
+    report('format_bch_amount', n, time_n(lambda: run.format_bch_amount(1_055_736), n))
+    report('format_fiat_amount', n, time_n(lambda: run.format_fiat_amount(1_055_736, 'EUR'), n))
+    report('format_fiat_speech', n, time_n(lambda: run.format_fiat_speech(1_055_736, 'EUR'), n))
+
+
+SAVE_SIZES = (10_000, 100_000, 1_000_000)
+
+
+@benchmark
+def bench_save_addresses() -> None:
+    rng = random.Random(0)
+    for size in SAVE_SIZES:
+        addresses = {'bitcoincash:' + base_addr: {'currency': 'USD'} for base_addr in fake_base_addrs(size, rng)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'addresses.pickle')
+
+            def save_whole():
+                with open(path, 'wb') as f:
+                    pickle.dump(addresses, f)
+
+            report(f'whole pickle rewrite, {size:,} addresses', 1, time_n(save_whole, 1))
+            store = address_store.AddressStoreLog(path, compact_every=10 ** 9)
+            store.load()
+            address = next(iter(addresses))
+            n = 1000
+
+            async def save_records():
+                for _ in range(n):
+                    await store.save(address, addresses[address])
+
+            loop = asyncio.get_event_loop()
+            report(f'AddressStoreLog.save, {size:,} addresses', n,
+                   time_n(lambda: loop.run_until_complete(save_records()), 1))
+
+
+COLD_START_SIZES = (100_000, 1_000_000)
+COLD_START_SCRIPT = '''
+import time
+started = time.perf_counter()
+import run
+print(time.perf_counter() - started, run.wallet.address_count())
+'''
+
+
+def time_run_import(addresses_path: str) -> float:
+    tmp_dir = os.path.dirname(addresses_path)
+    env = {**os.environ, 'ONESIGNAL_APP_KEY': 'benchmark', 'ONESIGNAL_APP_ID': 'benchmark', 'ROLE': 'single',
+           'ADDRESSES_PATH': addresses_path, 'SPEECH_PATH': os.path.join(tmp_dir, 'speech'),
+           'PAYMENT_HISTORY_PATH': os.path.join(tmp_dir, 'payments.sqlite'),
+           'EXCHANGE_RATES_PATH': os.path.join(tmp_dir, 'exchange_rates.pickle')}
+    output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], env=env, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE).stdout
+    seconds, _ = output.split()
+    return float(seconds)
+
+
+@benchmark
+def bench_cold_start() -> None:
+    watched = random_addresses(20_000)
+    decode_seconds = time_n(lambda: wallet.WalletDefault().add_address_keys(
+        [address_registry.key_for_address(Address.from_string(address)) for address in watched]), 1)
+    raw_seconds = time_n(lambda: wallet.WalletDefault().add_address_keys(
+        address_registry.raw_key(address[len('bitcoincash:'):]) for address in watched), 1)
+    report('wallet registration, cashaddr decode', len(watched), decode_seconds)
+    report('wallet registration, raw', len(watched), raw_seconds)
+
+    rng = random.Random(0)
+    currencies = ['USD', 'EUR', 'JPY', 'GBP']
+    for size in COLD_START_SIZES:
+        addresses = {'bitcoincash:' + base_addr: {'currency': rng.choice(currencies)}
+                     for base_addr in fake_base_addrs(size, rng)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'addresses.pickle')
+            with open(path, 'wb') as f:
+                pickle.dump(addresses, f)
+            legacy_seconds = time_run_import(path)
+            address_store.AddressStoreLog(path).compact()
+            snapshot_seconds = time_run_import(path)
+        print(f'import run.py, {size:>9,} addresses: legacy pickle {legacy_seconds:6.2f} s, '
+              f'grouped snapshot {snapshot_seconds:6.2f} s')
+
+
+REGISTRY_MEMORY_SIZES = (100_000, 1_000_000)
+
+
+def traced_mb(build: Callable[[], object]) -> float:
+    tracemalloc.start()
+    built = build()
+    traced = tracemalloc.get_traced_memory()[0]
+    del built
+    tracemalloc.stop()
+    return traced / 1024 / 1024
+
+
+@benchmark
+def bench_registry_memory() -> None:
+    rng = random.Random(0)
+    currencies = ['USD', 'EUR', 'JPY', 'GBP']
+    for size in REGISTRY_MEMORY_SIZES:
+        stored = {'bitcoincash:' + base_addr: {'currency': rng.choice(currencies)}
+                  for base_addr in fake_base_addrs(size, rng)}
+
+        def build_strings():
+            # the previous layout: a dict per subscriber keyed by the full cashaddr, and the wallet
+            # holding the prefix-less strings in a set plus one set per shard
+            addresses = {address: dict(record) for address, record in stored.items()}
+            listening = {address.split(':')[1] for address in addresses}
+            shards = [set() for _ in range(len(listening) // 500 + 1)]
+            for i, base_addr in enumerate(listening):
+                shards[i // 500].add(base_addr)
+            return addresses, listening, shards
+
+        def build_registry():
+            addresses = address_registry.AddressRegistry()
+            for address, record in stored.items():
+                addresses[address] = record
+            watching = wallet.WalletDefault()
+            watching.add_address_keys(addresses.keys_raw())
+            return addresses, watching
+
+        strings_mb = traced_mb(build_strings)
+        registry_mb = traced_mb(build_registry)
+        print(f'{size:>9,} addresses: strings and dicts {strings_mb:8.1f} MB, '
+              f'AddressRegistry and wallet keys {registry_mb:8.1f} MB ({registry_mb / strings_mb:.0%})')
+
+
+@benchmark
+def bench_seen_filter() -> None:
+    n = 200_000
+    keys = [(f'{i:064x}', 'bitcoincash:' + base_addr)
+            for i, base_addr in enumerate(fake_base_addrs(n, random.Random(0)))]
+    for name, make in [('SeenExpiring', seen.SeenExpiring), ('SeenBloom', seen.SeenBloom)]:
+        filled = []
+
+        def fill():
+            filled.append(make())
+            for key in keys:
+                filled[0].check_and_add(key)
+            return filled[0]
+
+        memory_mb = traced_mb(fill)
+        seen_payments = filled[0]
+        # a reconnect redelivering every tx
+        report(f'{name}.check_and_add, redelivered', n,
+               time_n(lambda: [seen_payments.check_and_add(key) for key in keys], 1))
+        print(f'{name}: {memory_mb:.1f} MB for {n:,} payments, hit rate {seen_payments.hit_rate():.1%}')
+
+
+@benchmark
+def bench_payment_history() -> None:
+    n_busy, n_other = 100_000, 100_000
+    rng = random.Random(0)
+    busy = bytes(21)
+    others = [bytes([0]) + rng.getrandbits(160).to_bytes(20, 'big') for _ in range(1000)]
+    rows = [(busy, f'{i:064x}', 1000 + i, 0.5, 'EUR', 1e9 + i) for i in range(n_busy)]
+    rows += [(rng.choice(others), f'{n_busy + i:064x}', 1000, 0.5, 'EUR', 1e9 + rng.random() * n_busy)
+             for i in range(n_other)]
+    rng.shuffle(rows)
+
+    async def run(history):
+        started = time.perf_counter()
+        for i, row in enumerate(rows):
+            history.record(*row)
+            if i % 1000 == 999:
+                await history.flush()
+        await history.flush()
+        report('PaymentHistory.record + flush', len(rows), time.perf_counter() - started)
+
+        async def page(n, **kwargs):
+            started = time.perf_counter()
+            for _ in range(n):
+                payments = await history.payments(busy, limit=100, **kwargs)
+            assert len(payments) == 100
+            return time.perf_counter() - started
+
+        report(f'history first page, {n_busy:,} payments', 200, await page(200))
+        middle = (1e9 + n_busy / 2, f'{n_busy // 2:064x}')
+        report(f'history middle page, {n_busy:,} payments', 200, await page(200, before=middle))
+        report('history page since an hour ago', 200, await page(200, since=1e9 + n_busy - 3600))
+
+        # a full scan of the busy address one page at a time
+        started = time.perf_counter()
+        before, pages = None, 0
+        while True:
+            payments = await history.payments(busy, before=before, limit=1000)
+            pages += 1
+            if len(payments) < 1000:
+                break
+            before = payments[-1]['received_at'], payments[-1]['tx_hash']
+        report('history pages of 1000, full walk', pages, time.perf_counter() - started)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history = payment_history.PaymentHistorySqlite(os.path.join(tmp_dir, 'payments.sqlite'))
+        asyncio.get_event_loop().run_until_complete(run(history))
+        print(f'history file: {os.path.getsize(os.path.join(tmp_dir, "payments.sqlite")) / 1e6:.1f} MB '
+              f'for {len(rows):,} payments')
+
+
+def synthetic_block(n_txs: int, outputs_per_tx: int, hit_rate: float, watched_base_addrs: List[str],
+                    rng: random.Random) -> Dict:
+    messages, _ = synthetic_messages(n_txs, outputs_per_tx, hit_rate, watched_base_addrs, rng, txs_per_message=n_txs)
+    return {'type': 'block', 'index': 800_000, 'data': messages[0]['data']}
+
+
+@benchmark
+def bench_block_matching() -> None:
+    run = import_run()
+    rng = random.Random(0)
+    watched_keys = [bytes(1) + rng.getrandbits(160).to_bytes(20, 'big') for _ in range(100_000)]
+    watched = [address_registry.raw_address(key) for key in watched_keys]
+    run.wallet = wallet.WalletDefault()
+    run.wallet.add_address_keys(watched_keys)
+    run.addresses.clear()
+    for key in watched_keys:
+        run.addresses.set_key(key, {'currency': 'EUR'})
+    run.exchange_rates = exchange_rate.ExchangeRateFixed()
+    for hit_rate in (0.001, 0.01, 0.1):
+        block = synthetic_block(10_000, 2, hit_rate, watched, rng)
+        txs = [tx_event.TxBitsocket(tx_dict) for tx_dict in block['data']]
+        per_tx = time_n(lambda: [run.match_tx(tx) for tx in txs], 1)
+        whole_block = time_n(lambda: run.match_block(txs), 1)
+        print(f'10,000 tx block, hit rate {hit_rate:>5.1%}: per tx {per_tx * 1000:>7.1f} ms, '
+              f'whole block {whole_block * 1000:>7.1f} ms')
+
+        run.seen_payments = seen.SeenExpiring()
+        run.notifications = notifier.NotifierOneSignal('app', 'auth', max_queue_size=10 ** 6)
+        started = time.perf_counter()
+        run.receive_block(txs, block['index'])
+        elapsed = time.perf_counter() - started
+        print(f'    receive_block {elapsed * 1000:.1f} ms, {run.notifications.queue_depth():,} notifications')
+
+
+class WalletMessages(wallet.WalletDefault):
+    def __init__(self, messages: List[Dict], started: Dict[str, float]) -> None:
+        super().__init__()
+        self._messages = messages
+        self._started = started
+
+    async def listen(self):
+        loop = asyncio.get_event_loop()
+        for message in self._messages:
+            now = loop.time()
+            for tx_dict in message['data']:
+                self._started[tx_dict['tx']['h']] = now
+            yield message
+
+
+class TextToSpeechStub:
+    def voice_key(self) -> str:
+        return 'stub'
+
+    def synthesize(self, text: str) -> bytes:
+        return b'\xff\xf3' * 1000
+
+
+class TextToSpeechRemoteStub:
+    # stands in for the Google TTS round trip when no credentials are configured
+    LATENCY = 0.4
+
+    def voice_key(self) -> str:
+        return 'remote-stub'
+
+    def synthesize(self, text: str) -> bytes:
+        time.sleep(self.LATENCY)
+        return text_to_speech._test_mp3(text, frames=20)
+
+
+async def time_to_audio(cache: text_to_speech.SpeechCache, texts: List[str]) -> List[float]:
+    loop = asyncio.get_event_loop()
+    durations = []
+    for text in texts:
+        started = loop.time()
+        await cache.speech_file(text)
+        durations.append(loop.time() - started)
+    return sorted(durations)
+
+
+@benchmark
+def bench_speech_composition() -> None:
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        speech, remote = text_to_speech.TextToSpeech(tempfile.mkdtemp()), 'Google TTS'
+    else:
+        speech, remote = TextToSpeechRemoteStub(), f'stub sleeping {TextToSpeechRemoteStub.LATENCY * 1000:.0f} ms'
+    rng = random.Random(0)
+    texts = [f'Received {rng.randrange(1, 100_000) / 100:.2f} {rng.choice(["USD", "EUR", "GBP"])}' for _ in range(20)]
+    executor = ThreadPoolExecutor(4)
+
+    async def run():
+        remote_cache = text_to_speech.SpeechCache(speech, tempfile.mkdtemp(), executor)
+        remote_durations = await time_to_audio(remote_cache, texts)
+
+        composer = text_to_speech.SpeechComposer(speech, tempfile.mkdtemp(), executor,
+                                                 exchange_rate.CurrenciesInfoFixed())
+        prepare_started = time.perf_counter()
+        await composer.prepare()
+        prepare_seconds = time.perf_counter() - prepare_started
+        composed_cache = text_to_speech.SpeechCache(composer, tempfile.mkdtemp(), executor)
+        composed_durations = await time_to_audio(composed_cache, texts)
+
+        for name, durations in [(f'remote ({remote})', remote_durations), ('composed', composed_durations)]:
+            print(f'time to audio, {name:<30} p50 {durations[len(durations) // 2] * 1000:8.2f} ms, '
+                  f'max {durations[-1] * 1000:8.2f} ms')
+        print(f'clip library: {composer.stats()["clips"]} clips rendered in {prepare_seconds:.1f} s, '
+              f'{composer.stats()["composed"]} of {len(texts)} texts composed')
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+class WebSocketStub:
+    def __init__(self) -> None:
+        self._closed = asyncio.Event()
+
+    async def send_str(self, message: str) -> None:
+        pass
+
+    async def close(self) -> None:
+        self._closed.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._closed.wait()
+        raise StopAsyncIteration
+
+
+def synthetic_messages(n_txs: int, outputs_per_tx: int, hit_rate: float, watched_base_addrs: List[str],
+                       rng: random.Random, txs_per_message: int = 1) -> Tuple[List[Dict], Set[Tuple[str, str]]]:
+    unwatched = fake_base_addrs(1000, rng)
+    messages = []
+    expected = set()
+    for message_idx in range(0, n_txs, txs_per_message):
+        txs = []
+        for tx_idx in range(message_idx, min(n_txs, message_idx + txs_per_message)):
+            tx_hash = f'{tx_idx:064x}'
+            outputs = []
+            for i in range(outputs_per_tx):
+                if rng.random() < hit_rate:
+                    base_addr = rng.choice(watched_base_addrs)
+                    expected.add((tx_hash, base_addr))
+                else:
+                    base_addr = rng.choice(unwatched)
+                outputs.append({'i': i, 'e': {'v': rng.randrange(546, 10 ** 9), 'i': i, 'a': base_addr}})
+            txs.append({'tx': {'h': tx_hash}, 'out': outputs})
+        messages.append({'type': 'mempool', 'data': txs})
+    return messages, expected
+
+
+async def run_end_to_end(run, n_txs: int, outputs_per_tx: int, hit_rate: float, coalesce_window: float = 0,
+                         n_watched: int = 1000) -> None:
+    loop = asyncio.get_event_loop()
+    rng = random.Random(0)
+    watched = random_addresses(n_watched)
+    started = {}
+    messages, expected = synthetic_messages(n_txs, outputs_per_tx, hit_rate,
+                                            [address.split(':')[1] for address in watched], rng)
+    delivered = []
+
+    async def handle_notification(request):
+        payload = await request.json()
+        # coalesced notifications link to the address rather than to a tx
+        delivered.append((payload['url'].rsplit('/', 1)[1], loop.time()))
+        return web.json_response({'id': 'stub'})
+
+    app = web.Application()
+    app.add_routes([web.post('/notifications', handle_notification)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    tmp_dir = tempfile.mkdtemp()
+    run.wallet = WalletMessages(messages, started)
+    run.wallet.add_address_keys(address_registry.address_key(address) for address in watched)
+    run.addresses.clear()
+    run.addresses.update({address: {'currency': 'EUR'} for address in watched})
+    run.exchange_rates = exchange_rate.ExchangeRateFixed()
+    run.seen_payments = seen.SeenExpiring()
+    run.notify_coalesce_window = coalesce_window
+    run.payment_coalescer = pipeline.Coalescer(coalesce_window, coalesce_window * 4,
+                                               lambda address, payments: run.fanout_stage.put((address, payments)))
+    run.notifications = notifier.NotifierOneSignal('app', 'auth', api_url=f'http://127.0.0.1:{port}/notifications',
+                                                   max_in_flight=32, max_queue_size=10 ** 6)
+    run.speech_cache = text_to_speech.SpeechCache(TextToSpeechStub(), tmp_dir, ThreadPoolExecutor(4))
+    run.history = payment_history.PaymentHistorySqlite(os.path.join(tmp_dir, 'payments.sqlite'))
+    sockets = [WebSocketStub() for _ in watched]
+    served = [asyncio.ensure_future(run.address_websockets.serve(address, ws))
+              for address, ws in zip(watched, sockets)]
+    tasks = [asyncio.ensure_future(run.notifications.listen()), asyncio.ensure_future(run.tx_pipeline.run()),
+             asyncio.ensure_future(run.history.listen())]
+
+    t0 = loop.time()
+    await run.listen_txs()
+    await run.tx_pipeline.join()
+    await run.payment_coalescer.join()
+    await run.tx_pipeline.join()
+    await asyncio.wait_for(run.notifications.join(), 600)
+    elapsed = loop.time() - t0
+
+    for task in tasks:
+        task.cancel()
+    for ws in sockets:
+        await ws.close()
+    await asyncio.gather(*served, *tasks, return_exceptions=True)
+    await runner.cleanup()
+
+    latencies = sorted(delivered_at - started[tx_hash] for tx_hash, delivered_at in delivered if tx_hash in started)
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else float('nan')
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan')
+    coalescing = f', coalesce {coalesce_window * 1000:.0f} ms' if coalesce_window else ''
+    print(f'{n_txs:>7,} txs x {outputs_per_tx:>3} outputs, hit rate {hit_rate:>5.1%}{coalescing}: '
+          f'{n_txs / elapsed:>10,.0f} tx/s, {len(delivered):>6,} notifications for {len(expected):>6,} payments, '
+          f'p50 {p50:>8.1f} ms, p99 {p99:>8.1f} ms, peak rss {peak_rss_mb():>7.1f} MB')
+
+
+END_TO_END_CASES = (
+    (10_000, 2, 0.0),
+    (10_000, 2, 0.01),
+    (10_000, 2, 0.1),
+    (2_000, 50, 0.01),
+    (10_000, 2, 0.1, 0.3),
+)
+
+
+@benchmark
+def bench_end_to_end() -> None:
+    run = import_run()
+    for case in END_TO_END_CASES:
+        asyncio.get_event_loop().run_until_complete(run_end_to_end(run, *case))
+
+
+def main(names: List[str]) -> None:
+    for name in names or BENCHMARKS:
+        print(f'== {name}')
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,151 @@
+import asyncio
+import collections
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from aiohttp import web
+
+
+class _Client:
+    __slots__ = ('ws', 'queue', 'writer')
+
+    def __init__(self, ws: web.WebSocketResponse, max_queue_size: int) -> None:
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.writer: asyncio.Future = None
+
+
+class BroadcastHub:
+    def __init__(self, max_queue_size: int = 16, send_timeout: float = 10.0,
+                 on_first_client: Optional[Callable[[str], None]] = None,
+                 on_last_client: Optional[Callable[[str], None]] = None) -> None:
+        self._max_queue_size = max_queue_size
+        self._send_timeout = send_timeout
+        self._on_first_client = on_first_client
+        self._on_last_client = on_last_client
+        self._clients: Dict[str, Set[_Client]] = {}
+        self._counts = collections.Counter()
+
+    def has_clients(self, key: str) -> bool:
+        return key in self._clients
+
+    def keys(self) -> Iterable[str]:
+        return iter(self._clients.keys())
+
+    async def serve(self, key: str, ws: web.WebSocketResponse) -> None:
+        client = _Client(ws, self._max_queue_size)
+        if key not in self._clients:
+            self._clients[key] = set()
+            if self._on_first_client is not None:
+                self._on_first_client(key)
+        self._clients[key].add(client)
+        self._counts['connected'] += 1
+        client.writer = asyncio.ensure_future(self._write(key, client))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self._remove(key, client)
+
+    def broadcast(self, key: str, message: str) -> int:
+        sent = 0
+        for client in list(self._clients.get(key, ())):
+            try:
+                client.queue.put_nowait(message)
+                sent += 1
+            except asyncio.QueueFull:
+                self._counts['dropped'] += 1
+                self._evict(key, client)
+        return sent
+
+    async def _write(self, key: str, client: _Client) -> None:
+        while True:
+            message = await client.queue.get()
+            try:
+                await asyncio.wait_for(client.ws.send_str(message), self._send_timeout)
+                self._counts['sent'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._counts['dropped'] += 1 + client.queue.qsize()
+                self._evict(key, client)
+                return
+
+    def _evict(self, key: str, client: _Client) -> None:
+        if self._remove(key, client):
+            self._counts['evicted'] += 1
+            asyncio.ensure_future(client.ws.close())
+
+    def _remove(self, key: str, client: _Client) -> bool:
+        clients = self._clients.get(key)
+        if clients is None or client not in clients:
+            return False
+        clients.discard(client)
+        if not clients:
+            del self._clients[key]
+            if self._on_last_client is not None:
+                self._on_last_client(key)
+        if client.writer is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+        return True
+
+    def client_count(self) -> int:
+        return sum(len(clients) for clients in self._clients.values())
+
+    def stats(self) -> Dict:
+        return {
+            'clients': self.client_count(),
+            'keys': len(self._clients),
+            **self._counts,
+        }
+
+
+def _test():
+    class WebSocketFake:
+        def __init__(self, stall=False):
+            self.sent = []
+            self.closed = asyncio.Event()
+            self._stall = stall
+
+        async def send_str(self, message):
+            if self._stall:
+                await asyncio.sleep(3600)
+            self.sent.append(message)
+
+        async def close(self):
+            self.closed.set()
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            await self.closed.wait()
+            raise StopAsyncIteration
+
+    async def run():
+        watched = set()
+        hub = BroadcastHub(max_queue_size=2, send_timeout=0.1,
+                           on_first_client=watched.add, on_last_client=watched.discard)
+        fast, slow = WebSocketFake(), WebSocketFake(stall=True)
+        served = [asyncio.ensure_future(hub.serve('addr', ws)) for ws in (fast, slow)]
+        await asyncio.sleep(0)
+        assert hub.client_count() == 2
+        assert watched == {'addr'}
+
+        for i in range(4):
+            hub.broadcast('addr', f'/speech/{i}.mp3')
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(slow.closed.wait(), 1)
+        assert fast.sent == [f'/speech/{i}.mp3' for i in range(4)]
+        assert hub.client_count() == 1
+        assert hub.stats()['evicted'] == 1 and hub.stats()['dropped'] > 0
+
+        await fast.close()
+        await asyncio.wait_for(asyncio.gather(*served), 1)
+        assert not hub.has_clients('addr')
+        assert watched == set()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,9 +1,19 @@
 import asyncio
+import logging
+import os
+import pickle
+import time
 from abc import ABCMeta, abstractmethod
-from typing import Iterable, Dict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import aiohttp
 
+import metrics
+
+logger = logging.getLogger(__name__)
+refresh_duration = metrics.histogram('notifybch_exchange_rate_refresh_seconds',
+                                     'Duration of an exchange rate refresh round.')
+
 
 class ExchangeRate(metaclass=ABCMeta):
     @abstractmethod
@@ -37,22 +47,29 @@ class ExchangeRateFixed(ExchangeRate):
 class ExchangeRateApi(ExchangeRate):
     API_URL = 'https://api.coinbase.com/v2/exchange-rates?currency=BCH'
 
-    def __init__(self) -> None:
-        self._api_url = self.API_URL
+    def __init__(self, api_url: str = API_URL, timeout: float = 10) -> None:
+        self._api_url = api_url
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
         self._last_result = {}
 
     def for_currency(self, currency_name: str) -> float:
         return self._last_result[currency_name]
 
+    async def fetch(self, session: aiohttp.ClientSession) -> Dict[str, float]:
+        async with session.get(self._api_url, timeout=self._timeout) as response:
+            currencies_dict = await response.json()
+            return {
+                currency_name: 100_000_000 / float(rate)
+                for currency_name, rate in currencies_dict['data']['rates'].items()
+            }
+
     async def listen(self) -> None:
         async with aiohttp.ClientSession() as session:
             while True:
-                async with session.get(self._api_url) as response:
-                    currencies_dict = await response.json()
-                    self._last_result = {
-                        currency_name: 100_000_000 / float(rate)
-                        for currency_name, rate in currencies_dict['data']['rates'].items()
-                    }
+                try:
+                    self._last_result = await self.fetch(session)
+                except Exception as e:
+                    logger.warning('exchange rate refresh failed: %r', e)
                 await asyncio.sleep(100)
 
     def currencies(self) -> Iterable[str]:
@@ -62,26 +79,256 @@ class ExchangeRateApi(ExchangeRate):
 class ExchangeRateBitcoinCom(ExchangeRate):
     API_URL = 'https://index-api.bitcoin.com/api/v0/cash/price/'
 
-    def __init__(self) -> None:
-        self._api_url = self.API_URL
+    def __init__(self, api_url: str = API_URL, max_concurrency: int = 8,
+                 default_interval: float = 100, idle_interval: float = 900,
+                 intervals: Optional[Dict[str, float]] = None,
+                 demand: Optional[Callable[[], Iterable[str]]] = None, demand_interval: float = 60,
+                 bulk_source: Optional[ExchangeRateApi] = None, tick: float = 5, timeout: float = 10,
+                 retry_delay: float = 30) -> None:
+        self._api_url = api_url
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._max_concurrency = max_concurrency
+        self._default_interval = default_interval
+        self._idle_interval = idle_interval
+        self._intervals = intervals or {}
+        self._demand = demand
+        self._demand_interval = demand_interval
+        self._demanded = set()
+        self._demand_updated = None
+        self._bulk_source = bulk_source
+        self._tick = tick
+        self._retry_delay = retry_delay
         self._last_result = {}
+        self._last_updated: Dict[str, float] = {}
+        # currency -> (time of the last failed fetch, failures in a row)
+        self._failures: Dict[str, Tuple[float, int]] = {}
+        self._last_round_duration = None
         self._currencies = list(CurrenciesInfoFixed().currencies())
 
     def for_currency(self, currency_name: str) -> float:
         return self._last_result[currency_name]
 
+    def _refresh_interval(self, currency: str) -> float:
+        if currency in self._intervals:
+            return self._intervals[currency]
+        if self._demand is not None and currency not in self._demanded:
+            return self._idle_interval
+        return self._default_interval
+
+    def _update_demand(self, now: float) -> None:
+        if self._demand is None:
+            return
+        if self._demand_updated is None or now - self._demand_updated >= self._demand_interval:
+            self._demanded = set(self._demand())
+            self._demand_updated = now
+
+    def _is_due(self, currency: str, now: float) -> bool:
+        if currency in self._failures:
+            # doubling from retry_delay up to idle_interval, so an unsupported currency or an outage
+            # isn't asked for on every tick
+            failed_at, failures = self._failures[currency]
+            return now - failed_at >= min(self._retry_delay * 2 ** (failures - 1), self._idle_interval)
+        return (currency not in self._last_updated
+                or now - self._last_updated[currency] >= self._refresh_interval(currency))
+
+    def _due_currencies(self, now: float) -> List[str]:
+        due = [currency for currency in self._currencies if self._is_due(currency, now)]
+        due.sort(key=lambda currency: currency not in self._demanded)
+        return due
+
+    async def _fetch_currency(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                              currency: str) -> None:
+        async with semaphore:
+            try:
+                async with session.get(f'{self._api_url}{currency}', timeout=self._timeout) as response:
+                    d = await response.json()
+                    self._last_result[currency] = 100_000_000 / (float(d['price']) / 100)
+                    self._last_updated[currency] = time.time()
+                    self._failures.pop(currency, None)
+            except Exception as e:
+                _, failures = self._failures.get(currency, (None, 0))
+                self._failures[currency] = (time.time(), failures + 1)
+                logger.warning('exchange rate refresh failed for %s: %r', currency, e)
+
+    async def _fetch_bulk(self, session: aiohttp.ClientSession) -> None:
+        try:
+            rates = await self._bulk_source.fetch(session)
+        except Exception as e:
+            logger.warning('bulk exchange rate refresh failed: %r', e)
+            return
+        now = time.time()
+        for currency in self._currencies:
+            if currency in rates:
+                self._last_result[currency] = rates[currency]
+                self._last_updated[currency] = now
+                self._failures.pop(currency, None)
+
+    async def refresh(self, session: aiohttp.ClientSession) -> None:
+        started = time.time()
+        self._update_demand(started)
+        due = self._due_currencies(started)
+        if not due:
+            return
+        if self._bulk_source is not None:
+            await self._fetch_bulk(session)
+            due = self._due_currencies(time.time())
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        await asyncio.gather(*[self._fetch_currency(session, semaphore, currency) for currency in due])
+        self._last_round_duration = time.time() - started
+        refresh_duration.observe(self._last_round_duration)
+
     async def listen(self) -> None:
         async with aiohttp.ClientSession() as session:
             while True:
-                for currency in self._currencies:
-                    async with session.get(f'{self._api_url}{currency}') as response:
-                        d = await response.json()
-                        self._last_result[currency] = 100_000_000 / (float(d['price']) / 100)
-                await asyncio.sleep(100)
+                await self.refresh(session)
+                await asyncio.sleep(self._tick)
 
     def currencies(self) -> Iterable[str]:
         return iter(self._currencies)
 
+    def staleness(self) -> Dict[str, Optional[float]]:
+        now = time.time()
+        return {
+            currency: now - self._last_updated[currency] if currency in self._last_updated else None
+            for currency in self._currencies
+        }
+
+    def stats(self) -> Dict:
+        ages = [age for age in self.staleness().values() if age is not None]
+        return {
+            'currencies': len(self._currencies),
+            'currencies_with_rate': len(ages),
+            'demanded_currencies': len(self._demanded),
+            'failing_currencies': len(self._failures),
+            'max_staleness': max(ages) if ages else None,
+            'last_round_duration': self._last_round_duration,
+        }
+
+
+class ExchangeRateComposite(ExchangeRate):
+    """
+    Rate from the first source that has one, else the last rate any source gave. Every rate
+    served is remembered and saved to path, so it is available right after a restart. A failing
+    source is restarted, never waited on. fallback's rates may be long out of date, so only
+    approximate_for_currency answers from it.
+    """
+
+    def __init__(self, sources: List[ExchangeRate], fallback: Optional[ExchangeRate] = None,
+                 path: Optional[str] = None, save_interval: float = 300, restart_delay: float = 10) -> None:
+        self._sources = sources
+        self._fallback = fallback
+        self._path = path
+        self._save_interval = save_interval
+        self._restart_delay = restart_delay
+        self._last_good: Dict[str, float] = self._load()
+        self._fallbacks = 0
+
+    def _load(self) -> Dict[str, float]:
+        if self._path is None:
+            return {}
+        try:
+            with open(self._path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            logger.exception('could not read exchange rates from %s', self._path)
+            return {}
+        logger.info('loaded %d exchange rates saved %.0fs ago', len(snapshot['rates']),
+                    time.time() - snapshot['saved_at'])
+        return snapshot['rates']
+
+    def _source_rate(self, currency_name: str) -> Optional[float]:
+        for source in self._sources:
+            try:
+                rate = source.for_currency(currency_name)
+            except (KeyError, ValueError):
+                continue
+            self._last_good[currency_name] = rate
+            return rate
+        return None
+
+    def for_currency(self, currency_name: str) -> float:
+        rate = self._source_rate(currency_name)
+        if rate is not None:
+            return rate
+        self._fallbacks += 1
+        if currency_name in self._last_good:
+            return self._last_good[currency_name]
+        raise KeyError(currency_name)
+
+    def approximate_for_currency(self, currency_name: str) -> float:
+        """for_currency, else fallback's rate, for uses where an old rate is better than none."""
+        try:
+            return self.for_currency(currency_name)
+        except KeyError:
+            if self._fallback is None:
+                raise
+        try:
+            return self._fallback.for_currency(currency_name)
+        except ValueError:
+            raise KeyError(currency_name)
+
+    def rates(self) -> Dict[str, float]:
+        # read from the sources directly, so saving doesn't count as fallbacks
+        for currency in list(self.currencies()):
+            self._source_rate(currency)
+        return dict(self._last_good)
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'saved_at': time.time(), 'rates': self.rates()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path)
+
+    async def _supervise(self, source: ExchangeRate) -> None:
+        while True:
+            try:
+                await source.listen()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('exchange rate source %s failed, restarting', type(source).__name__)
+            await asyncio.sleep(self._restart_delay)
+
+    async def _save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._save_interval)
+            try:
+                self.save()
+            except OSError:
+                logger.exception('could not save exchange rates to %s', self._path)
+
+    async def listen(self) -> None:
+        await asyncio.gather(*[self._supervise(source) for source in self._sources], self._save_periodically())
+
+    def currencies(self) -> Iterable[str]:
+        currencies = dict.fromkeys(self._last_good)
+        for source in self._sources:
+            currencies.update(dict.fromkeys(source.currencies()))
+        return iter(currencies)
+
+    def staleness(self) -> Dict[str, Optional[float]]:
+        staleness: Dict[str, Optional[float]] = {}
+        for source in self._sources:
+            if not hasattr(source, 'staleness'):
+                continue
+            for currency, age in source.staleness().items():
+                known = staleness.get(currency)
+                staleness[currency] = age if known is None or (age is not None and age < known) else known
+        return staleness
+
+    def stats(self) -> Dict:
+        ages = [age for age in self.staleness().values() if age is not None]
+        return {
+            'currencies_with_rate': len(self._last_good),
+            'fallbacks': self._fallbacks,
+            'max_staleness': max(ages) if ages else None,
+        }
+
 
 class CurrenciesInfo(metaclass=ABCMeta):
     @abstractmethod
@@ -233,3 +480,124 @@ class CurrenciesInfoFixed(CurrenciesInfo):
 
     def format_for_code(self, currency_code: str) -> Dict:
         return self._currencies_info[currency_code]['format']
+
+
+def _test():
+    from aiohttp import web
+
+    async def run():
+        requested = []
+
+        async def handle_price(request):
+            currency = request.match_info['currency']
+            requested.append(currency)
+            if currency == 'KRW':
+                return web.json_response({'error': 'unsupported'}, status=404)
+            return web.json_response({'price': 20000})
+
+        async def handle_bulk(request):
+            requested.append('bulk')
+            return web.json_response({'data': {'rates': {'USD': '200', 'EUR': '100'}}})
+
+        app = web.Application()
+        app.add_routes([web.get('/price/{currency}', handle_price),
+                        web.get('/bulk', handle_bulk)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        rates = ExchangeRateBitcoinCom(
+            api_url=f'http://127.0.0.1:{port}/price/',
+            demand=lambda: ['JPY', 'USD'],
+            intervals={'JPY': 0},
+            bulk_source=ExchangeRateApi(f'http://127.0.0.1:{port}/bulk'),
+        )
+        async with aiohttp.ClientSession() as session:
+            await rates.refresh(session)
+            assert requested[0] == 'bulk'
+            assert requested[1] == 'JPY'
+            assert 'USD' not in requested and 'EUR' not in requested
+            assert len(requested) == len(list(rates.currencies())) - 1
+            assert rates.for_currency('USD') == 500_000
+            assert rates.for_currency('JPY') == 500_000
+            assert [currency for currency, age in rates.staleness().items() if age is None] == ['KRW']
+            assert rates.stats()['failing_currencies'] == 1
+
+            requested.clear()
+            await rates.refresh(session)
+            assert requested == ['bulk', 'JPY']
+
+            # a failed currency is retried after retry_delay, then after twice as long
+            failed_at, _ = rates._failures['KRW']
+            assert rates._due_currencies(failed_at + 29) == ['JPY']
+            assert 'KRW' in rates._due_currencies(failed_at + 30)
+            rates._failures['KRW'] = (failed_at, 2)
+            assert 'KRW' not in rates._due_currencies(failed_at + 59)
+        await runner.cleanup()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    _test_composite()
+
+
+def _test_composite():
+    import tempfile
+
+    class Failing(ExchangeRate):
+        def __init__(self):
+            self.rates = {}
+            self.starts = 0
+
+        def for_currency(self, currency_name):
+            return self.rates[currency_name]
+
+        async def listen(self):
+            self.starts += 1
+            raise RuntimeError('upstream down')
+
+        def currencies(self):
+            return iter(self.rates)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'rates.pickle')
+        primary, secondary = Failing(), Failing()
+        rates = ExchangeRateComposite([primary, secondary], fallback=ExchangeRateFixed(), path=path)
+        secondary.rates = {'USD': 2.0, 'CHF': 3.0}
+        primary.rates = {'USD': 1.0}
+        assert rates.for_currency('USD') == 1.0
+        assert rates.for_currency('CHF') == 3.0
+        assert rates.approximate_for_currency('EUR') == 861_474
+        for lookup, currency in [(rates.for_currency, 'EUR'), (rates.approximate_for_currency, 'KRW')]:
+            try:
+                lookup(currency)
+            except KeyError:
+                pass
+            else:
+                assert False
+        primary.rates, secondary.rates = {}, {}
+        assert rates.for_currency('USD') == 1.0
+        fallbacks = rates.stats()['fallbacks']
+        rates.save()
+        assert rates.stats()['fallbacks'] == fallbacks
+        secondary.staleness = lambda: {'USD': 5.0, 'CHF': None}
+        primary.staleness = lambda: {'USD': 2.0}
+        assert rates.staleness() == {'USD': 2.0, 'CHF': None}
+        assert rates.stats()['max_staleness'] == 2.0
+
+        restarted = ExchangeRateComposite([Failing()], path=path)
+        assert restarted.for_currency('USD') == 1.0 and restarted.for_currency('CHF') == 3.0
+        assert restarted.stats() == {'currencies_with_rate': 2, 'fallbacks': 2, 'max_staleness': None}
+
+        async def run():
+            supervised = ExchangeRateComposite([primary], restart_delay=0.01)
+            listening = asyncio.ensure_future(supervised.listen())
+            await asyncio.sleep(0.05)
+            listening.cancel()
+            assert primary.starts > 1
+
+        asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+# far above asyncio's 64 KiB default, since a bulk registration travels as a single line
+MAX_LINE = 16 * 1024 * 1024
+
+
+def _encode(event: Dict) -> bytes:
+    return json.dumps(event, separators=(',', ':')).encode() + b'\n'
+
+
+class _Connection:
+    __slots__ = ('writer', 'watching')
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.watching: Set[str] = set()
+
+
+class IpcServer:
+    """
+    Ingester side of the worker channel: newline-delimited JSON over a Unix socket.
+    Workers tell the ingester which addresses have websocket listeners ('watch' /
+    'unwatch'), so it can stand in for a BroadcastHub in tx_speech.
+    """
+
+    def __init__(self, path: str, on_message: Callable[[Dict], None],
+                 max_write_buffer: int = 4 * 1024 * 1024) -> None:
+        self._path = path
+        self._on_message = on_message
+        self._max_write_buffer = max_write_buffer
+        self._connections: Set[_Connection] = set()
+        self._watchers = collections.Counter()
+        self._counts = collections.Counter()
+        self._server: asyncio.AbstractServer = None
+
+    async def start(self) -> None:
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self._path, limit=MAX_LINE)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for connection in list(self._connections):
+            connection.writer.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = _Connection(writer)
+        self._connections.add(connection)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if event['type'] == 'watch':
+                    self._watch(connection, event['address'])
+                elif event['type'] == 'unwatch':
+                    self._unwatch(connection, event['address'])
+                else:
+                    self._on_message(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('worker connection failed')
+        finally:
+            self._connections.discard(connection)
+            for address in list(connection.watching):
+                self._unwatch(connection, address)
+            writer.close()
+
+    def _watch(self, connection: _Connection, address: str) -> None:
+        if address not in connection.watching:
+            connection.watching.add(address)
+            self._watchers[address] += 1
+
+    def _unwatch(self, connection: _Connection, address: str) -> None:
+        if address in connection.watching:
+            connection.watching.discard(address)
+            self._watchers[address] -= 1
+            if self._watchers[address] <= 0:
+                del self._watchers[address]
+
+    def has_clients(self, address: str) -> bool:
+        return address in self._watchers
+
+    def broadcast(self, address: str, message: str) -> int:
+        data = _encode({'type': 'speech', 'address': address, 'message': message})
+        return self._send(data, [connection for connection in self._connections
+                                 if address in connection.watching])
+
+    def publish(self, event: Dict) -> int:
+        return self._send(_encode(event), list(self._connections))
+
+    def _send(self, data: bytes, connections: Iterable[_Connection]) -> int:
+        sent = 0
+        for connection in connections:
+            if connection.writer.transport.get_write_buffer_size() > self._max_write_buffer:
+                self._counts['dropped'] += 1
+                continue
+            connection.writer.write(data)
+            sent += 1
+        self._counts['sent'] += sent
+        return sent
+
+    def stats(self) -> Dict:
+        return {
+            'workers': len(self._connections),
+            'watched_addresses': len(self._watchers),
+            **self._counts,
+        }
+
+
+class IpcClient:
+    def __init__(self, path: str, on_connect: Optional[Callable[[], Iterable[Dict]]] = None,
+                 reconnect_delay: float = 1.0, max_pending: int = 10_000) -> None:
+        self._path = path
+        self._on_connect = on_connect
+        self._reconnect_delay = reconnect_delay
+        self._writer: asyncio.StreamWriter = None
+        self._pending = collections.deque(maxlen=max_pending)
+        self._counts = collections.Counter()
+
+    def send(self, event: Dict) -> bool:
+        if self._writer is None:
+            if len(self._pending) == self._pending.maxlen:
+                self._counts['dropped'] += 1
+            self._pending.append(event)
+            return False
+        self._writer.write(_encode(event))
+        self._counts['sent'] += 1
+        return True
+
+    async def listen(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._path, limit=MAX_LINE)
+            except OSError as e:
+                logger.warning('could not connect to ingester: %r', e)
+                await asyncio.sleep(self._reconnect_delay)
+                continue
+            self._writer = writer
+            if self._on_connect is not None:
+                for event in self._on_connect():
+                    self.send(event)
+            while self._pending:
+                self.send(self._pending.popleft())
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    yield json.loads(line)
+            finally:
+                self._writer = None
+                writer.close()
+            self._counts['reconnects'] += 1
+            await asyncio.sleep(self._reconnect_delay)
+
+    def stats(self) -> Dict:
+        return {'connected': self._writer is not None, **self._counts}
+
+
+def _test():
+    import tempfile
+
+    async def run(path):
+        received = []
+        server = IpcServer(path, received.append)
+        await server.start()
+        client = IpcClient(path, on_connect=lambda: [{'type': 'watch', 'address': 'bitcoincash:a'}])
+        client.send({'type': 'register', 'address': 'bitcoincash:d', 'record': {'currency': 'USD'}})
+        events = client.listen()
+        next_event = asyncio.ensure_future(events.__anext__())
+
+        for _ in range(100):
+            if server.has_clients('bitcoincash:a'):
+                break
+            await asyncio.sleep(0.01)
+        assert server.has_clients('bitcoincash:a')
+        assert not server.has_clients('bitcoincash:b')
+        assert server.broadcast('bitcoincash:b', '/speech/x.mp3') == 0
+        assert server.broadcast('bitcoincash:a', '/speech/y.mp3') == 1
+        assert await asyncio.wait_for(next_event, 1) == {
+            'type': 'speech', 'address': 'bitcoincash:a', 'message': '/speech/y.mp3'}
+
+        client.send({'type': 'register', 'address': 'bitcoincash:c', 'record': {'currency': 'EUR'}})
+        client.send({'type': 'unwatch', 'address': 'bitcoincash:a'})
+        for _ in range(100):
+            if len(received) == 2 and not server.has_clients('bitcoincash:a'):
+                break
+            await asyncio.sleep(0.01)
+        assert received == [{'type': 'register', 'address': 'bitcoincash:d', 'record': {'currency': 'USD'}},
+                            {'type': 'register', 'address': 'bitcoincash:c', 'record': {'currency': 'EUR'}}]
+        assert not server.has_clients('bitcoincash:a')
+
+        # a bulk registration is one line of well over 64 KiB, in both directions
+        records = {f'bitcoincash:{i:042d}': {'currency': 'USD'} for i in range(10_000)}
+        client.send({'type': 'register', 'records': records})
+        server.publish({'type': 'addresses', 'records': records})
+        assert await asyncio.wait_for(events.__anext__(), 1) == {'type': 'addresses', 'records': records}
+        for _ in range(100):
+            if len(received) == 3:
+                break
+            await asyncio.sleep(0.01)
+        assert received[2] == {'type': 'register', 'records': records}
+
+        await events.aclose()
+        await server.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(os.path.join(tmp_dir, 'ingester.sock')))
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,62 @@
+import logging
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per logger and message template, so a reconnect loop or a burst of
+    failing requests can't flood the output. The next record that gets through
+    reports how many similar records were dropped.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 10) -> None:
+        super().__init__()
+        self._rate = rate
+        self._burst = burst
+        self._buckets = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        tokens, last, suppressed = self._buckets.get(key, (self._burst, now, 0))
+        tokens = min(self._burst, tokens + (now - last) * self._rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, suppressed + 1)
+            return False
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+        self._buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+def setup_logging(level: str = 'INFO', rate: float = 1.0, burst: int = 10) -> None:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(RateLimitFilter(rate, burst))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+
+
+def _test():
+    rate_limit = RateLimitFilter(rate=0, burst=2)
+
+    def make_record(msg):
+        return logging.LogRecord('test', logging.WARNING, __file__, 0, msg, (), None)
+
+    assert rate_limit.filter(make_record('failed %s'))
+    assert rate_limit.filter(make_record('failed %s'))
+    assert not rate_limit.filter(make_record('failed %s'))
+    assert rate_limit.filter(make_record('other'))
+
+    rate_limit = RateLimitFilter(rate=1000, burst=1)
+    assert rate_limit.filter(make_record('failed %s'))
+    assert not rate_limit.filter(make_record('failed %s'))
+    time.sleep(0.01)
+    record = make_record('failed %s')
+    assert rate_limit.filter(record)
+    assert record.msg == 'failed %s [1 similar messages suppressed]'
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,165 @@
+import asyncio
+import bisect
+import time
+from typing import Callable, Iterable, List, Optional
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self._value += amount
+
+    def value(self) -> int:
+        return self._value
+
+    def samples(self) -> Iterable[str]:
+        yield f'{self.name} {self._value}'
+
+
+class Gauge:
+    type_name = 'gauge'
+
+    def __init__(self, name: str, help_text: str, fn: Optional[Callable[[], float]] = None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._fn = fn
+        self._value = 0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def value(self) -> float:
+        return self._fn() if self._fn is not None else self._value
+
+    def samples(self) -> Iterable[str]:
+        yield f'{self.name} {_format_value(self.value())}'
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram: 'Histogram') -> None:
+        self._histogram = histogram
+
+    def __enter__(self) -> None:
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._buckets = sorted(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def count(self) -> int:
+        return self._count
+
+    def samples(self) -> Iterable[str]:
+        cumulative = 0
+        for upper_bound, count in zip(self._buckets + [float('inf')], self._counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{_format_value(upper_bound)}"}} {cumulative}'
+        yield f'{self.name}_sum {self._sum!r}'
+        yield f'{self.name}_count {self._count}'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric: {metric.name}')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return REGISTRY.register(Counter(name, help_text))
+
+
+def gauge(name: str, help_text: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+    return REGISTRY.register(Gauge(name, help_text, fn))
+
+
+def histogram(name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help_text, buckets))
+
+
+event_loop_lag = histogram('notifybch_event_loop_lag_seconds', 'Delay of a periodic timer on the event loop.')
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - expected))
+
+
+def _test():
+    registry = Registry()
+    requests = registry.register(Counter('requests_total', 'Requests.'))
+    depth = registry.register(Gauge('queue_depth', 'Depth.', lambda: 3))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0)))
+    requests.inc()
+    requests.inc(2)
+    latency.observe(0.05)
+    latency.observe(0.1)
+    latency.observe(5)
+    with latency.time():
+        pass
+    assert depth.value() == 3
+    text = registry.render()
+    assert 'requests_total 3\n' in text
+    assert 'queue_depth 3\n' in text
+    assert 'latency_seconds_bucket{le="0.1"} 3\n' in text
+    assert 'latency_seconds_bucket{le="1.0"} 3\n' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 4\n' in text
+    assert 'latency_seconds_count 4\n' in text
+    assert '# TYPE latency_seconds histogram\n' in text
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,190 @@
+import asyncio
+import collections
+import logging
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Optional
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+request_duration = metrics.histogram('notifybch_onesignal_request_seconds',
+                                     'Round-trip time of a single OneSignal request.')
+
+
+class Notifier(metaclass=ABCMeta):
+    @abstractmethod
+    def notify(self, bch_address: str, msg: str, url: str) -> None:
+        pass
+
+    @abstractmethod
+    async def listen(self) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict:
+        pass
+
+
+class NotifierOneSignal(Notifier):
+    API_URL = 'https://onesignal.com/api/v1/notifications'
+
+    def __init__(self, app_id: str, app_auth: str, api_url: str = API_URL,
+                 max_in_flight: int = 16, max_queue_size: int = 10_000,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 keepalive_timeout: float = 60.0, request_timeout: float = 10.0) -> None:
+        self._app_id = app_id
+        self._app_auth = app_auth
+        self._api_url = api_url
+        self._max_in_flight = max_in_flight
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._keepalive_timeout = keepalive_timeout
+        self._request_timeout = request_timeout
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._in_flight = 0
+        self._latencies = collections.deque(maxlen=1000)
+        self._counts = collections.Counter()
+
+    def notify(self, bch_address: str, msg: str, url: str) -> None:
+        payload = {
+            "app_id": self._app_id,
+            "contents": {"en": msg},
+            "url": url,
+            "filters": [
+                {"field": "tag", "key": "bchAddress", "relation": "=", "value": bch_address},
+            ],
+        }
+        try:
+            self._queue.put_nowait((asyncio.get_event_loop().time(), payload))
+            self._counts['queued'] += 1
+        except asyncio.QueueFull:
+            self._counts['dropped'] += 1
+            logger.warning('notification queue full, dropping notification for %s', bch_address)
+
+    async def listen(self) -> None:
+        connector = aiohttp.TCPConnector(limit=self._max_in_flight,
+                                         keepalive_timeout=self._keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(total=self._request_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.ensure_future(self._worker(session))
+                       for _ in range(self._max_in_flight)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+    async def _worker(self, session: aiohttp.ClientSession) -> None:
+        while True:
+            queued_at, payload = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await self._deliver(session, payload)
+                self._latencies.append(asyncio.get_event_loop().time() - queued_at)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _deliver(self, session: aiohttp.ClientSession, payload: Dict) -> bool:
+        for attempt in range(self._max_retries + 1):
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                async with session.post(
+                        self._api_url,
+                        headers={"Authorization": f'Basic {self._app_auth}'},
+                        json=payload,
+                ) as resp:
+                    request_duration.observe(time.perf_counter() - started)
+                    if resp.status < 300:
+                        await resp.read()
+                        self._counts['delivered'] += 1
+                        return True
+                    if resp.status == 429:
+                        self._counts['rate_limited'] += 1
+                        retry_after = self._parse_retry_after(resp.headers.get('Retry-After'))
+                    elif resp.status < 500:
+                        logger.warning('notification rejected: %s %s', resp.status, await resp.text())
+                        self._counts['failed'] += 1
+                        return False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning('notification request failed: %r', e)
+            if attempt < self._max_retries:
+                self._counts['retried'] += 1
+                if retry_after is None:
+                    retry_after = min(self._backoff_max, self._backoff_base * 2 ** attempt)
+                await asyncio.sleep(retry_after)
+        self._counts['failed'] += 1
+        return False
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            return None
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+        return {
+            'queue_depth': self.queue_depth(),
+            'in_flight': self._in_flight,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+            **self._counts,
+        }
+
+
+def _test():
+    from aiohttp import web
+
+    async def run():
+        received = []
+
+        async def handle(request):
+            payload = await request.json()
+            assert request.headers['Authorization'] == 'Basic auth'
+            if len(received) == 0:
+                received.append(None)
+                return web.Response(status=429, headers={'Retry-After': '0'})
+            received.append(payload)
+            return web.json_response({'id': 'x'})
+
+        app = web.Application()
+        app.add_routes([web.post('/notifications', handle)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        notifier = NotifierOneSignal('app', 'auth', api_url=f'http://127.0.0.1:{port}/notifications',
+                                     max_in_flight=2, backoff_base=0)
+        listen_future = asyncio.ensure_future(notifier.listen())
+        notifier.notify('bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4', 'Received 1 BCH', 'url1')
+        notifier.notify('bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l', 'Received 2 BCH', 'url2')
+        await asyncio.wait_for(notifier.join(), 5)
+        listen_future.cancel()
+        await runner.cleanup()
+
+        stats = notifier.stats()
+        assert stats['delivered'] == 2
+        assert stats['rate_limited'] == 1
+        assert stats['queue_depth'] == 0
+        assert sorted(payload['url'] for payload in received[1:]) == ['url1', 'url2']
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,261 @@
+import collections
+import email.utils
+import gzip
+import hashlib
+import os
+import re
+import time
+from string import Template
+from typing import Callable, Dict, Hashable, Iterable, Optional
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STARTED = time.time()
+
+
+def slot(name: str) -> str:
+    return f'\x00{name}\x00'
+
+
+class SplicedTemplate:
+    """
+    Template rendered once at startup, leaving markers for the per-request values,
+    so rendering a page is a single join.
+    """
+
+    def __init__(self, template: Template, static: Dict[str, str], slots: Iterable[str]) -> None:
+        slots = list(slots)
+        text = template.substitute(**static, **{name: slot(name) for name in slots})
+        self._parts = re.split('\x00(' + '|'.join(map(re.escape, slots)) + ')\x00', text)
+
+    def render(self, **values: str) -> str:
+        parts = self._parts[:]
+        parts[1::2] = [values[name] for name in self._parts[1::2]]
+        return ''.join(parts)
+
+
+class CachedPage:
+    def __init__(self, text: str, content_type: str = 'text/html', cache_control: str = 'no-cache',
+                 last_modified: Optional[float] = None) -> None:
+        self.body = text.encode()
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = '"' + hashlib.md5(self.body).hexdigest() + '"'
+        self.last_modified = last_modified
+        self._encoded = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        if encoding not in self._encoded:
+            if encoding == 'br':
+                self._encoded[encoding] = brotli.compress(self.body)
+            else:
+                self._encoded[encoding] = gzip.compress(self.body, compresslevel=9)
+        return self._encoded[encoding]
+
+    def precompress(self) -> 'CachedPage':
+        self.encoded('gzip')
+        if brotli is not None:
+            self.encoded('br')
+        return self
+
+    def _not_modified(self, request: web.Request) -> bool:
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return any(etag.strip() in (self.etag, '*', 'W/' + self.etag) for etag in if_none_match.split(','))
+        if self.last_modified is not None and request.if_modified_since is not None:
+            return request.if_modified_since.timestamp() >= int(self.last_modified)
+        return False
+
+    def response(self, request: web.Request) -> web.Response:
+        headers = {'ETag': self.etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if self.last_modified is not None:
+            headers['Last-Modified'] = email.utils.formatdate(self.last_modified, usegmt=True)
+        if self._not_modified(request):
+            return web.Response(status=304, headers=headers)
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        if brotli is not None and 'br' in accept_encoding:
+            headers['Content-Encoding'] = 'br'
+            body = self.encoded('br')
+        elif 'gzip' in accept_encoding:
+            headers['Content-Encoding'] = 'gzip'
+            body = self.encoded('gzip')
+        else:
+            body = self.body
+        return web.Response(body=body, headers=headers, content_type=self.content_type, charset='utf-8')
+
+
+class PageCache:
+    def __init__(self, max_pages: int = 1024) -> None:
+        self._max_pages = max_pages
+        self._pages = collections.OrderedDict()
+
+    def get(self, key: Hashable, render) -> CachedPage:
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+            return page
+        page = CachedPage(render())
+        self._pages[key] = page
+        if len(self._pages) > self._max_pages:
+            self._pages.popitem(last=False)
+        return page
+
+
+class StaticFiles:
+    """
+    Serves files from a directory where a name is never reused for different content, such as
+    content hashes, so they can be cached forever. Files still in memory after being written
+    come from hot_file, everything else goes through FileResponse and sendfile.
+    """
+
+    def __init__(self, path: str, name_pattern: str, hot_file: Callable[[str], Optional[bytes]] = None,
+                 cache_control: str = 'public, max-age=31536000, immutable', content_type: str = None) -> None:
+        self._path = path
+        self._name_pattern = re.compile(name_pattern)
+        self._hot_file = hot_file
+        self._cache_control = cache_control
+        self._content_type = content_type
+        self._counts = collections.Counter()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        file_name = request.match_info['file_name']
+        if self._name_pattern.fullmatch(file_name) is None:
+            self._counts['not_found'] += 1
+            raise web.HTTPNotFound()
+        etag = f'"{file_name}"'
+        headers = {'ETag': etag, 'Cache-Control': self._cache_control}
+        if self._content_type is not None:
+            headers['Content-Type'] = self._content_type
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and any(tag.strip() in (etag, '*', 'W/' + etag)
+                                             for tag in if_none_match.split(',')):
+            self._counts['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+        data = self._hot_file(file_name) if self._hot_file is not None else None
+        if data is not None:
+            self._counts['hot'] += 1
+            return self._memory_response(request, data, headers)
+        path = os.path.join(self._path, file_name)
+        if not os.path.isfile(path):
+            self._counts['not_found'] += 1
+            raise web.HTTPNotFound()
+        self._counts['sendfile'] += 1
+        return web.FileResponse(path, headers=headers)
+
+    @staticmethod
+    def _memory_response(request: web.Request, data: bytes, headers: Dict[str, str]) -> web.Response:
+        headers['Accept-Ranges'] = 'bytes'
+        if_range = request.headers.get('If-Range')
+        if 'Range' not in request.headers or (if_range is not None and if_range != headers['ETag']):
+            return web.Response(body=data, headers=headers)
+        try:
+            http_range = request.http_range
+        except ValueError:
+            http_range = None
+        size = len(data)
+        start, stop = (http_range.start, http_range.stop) if http_range is not None else (None, None)
+        if start is not None and start < 0:
+            start, stop = max(0, size + start), size
+        start = start or 0
+        stop = size if stop is None else min(stop, size)
+        if http_range is None or start >= stop:
+            headers['Content-Range'] = f'bytes */{size}'
+            return web.Response(status=416, headers=headers)
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        return web.Response(status=206, body=data[start:stop], headers=headers)
+
+    def stats(self) -> Dict:
+        return dict(self._counts)
+
+
+def _test():
+    import asyncio
+    from aiohttp.test_utils import make_mocked_request
+
+    spliced = SplicedTemplate(Template('<a href="/$address">$address</a> $appId $currency'),
+                              {'appId': 'app'}, ['address', 'currency'])
+    assert spliced.render(address='x', currency='EUR') == '<a href="/x">x</a> app EUR'
+
+    page = CachedPage('<html>' + 'x' * 1000 + '</html>', cache_control='public, max-age=86400',
+                      last_modified=STARTED).precompress()
+
+    async def run():
+        response = page.response(make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip, deflate'}))
+        assert response.status == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.body) == page.body
+
+        response = page.response(make_mocked_request('GET', '/', headers={'If-None-Match': page.etag}))
+        assert response.status == 304
+
+        last_modified = email.utils.formatdate(STARTED + 10, usegmt=True)
+        response = page.response(make_mocked_request('GET', '/', headers={'If-Modified-Since': last_modified}))
+        assert response.status == 304
+
+        response = page.response(make_mocked_request('GET', '/', headers={'If-None-Match': '"other"'}))
+        assert response.status == 200 and response.body == page.body
+
+    asyncio.get_event_loop().run_until_complete(run())
+    _test_static_files()
+
+    cache = PageCache(max_pages=1)
+    assert cache.get('a', lambda: 'a').body == b'a'
+    assert cache.get('a', lambda: 'changed').body == b'a'
+    cache.get('b', lambda: 'b')
+    assert cache.get('a', lambda: 'new').body == b'new'
+
+
+def _test_static_files():
+    import asyncio
+    import tempfile
+    import aiohttp
+
+    hot = {'hot.mp3': b'0123456789'}
+    with tempfile.TemporaryDirectory() as path:
+        with open(os.path.join(path, 'cold.mp3'), 'wb') as f:
+            f.write(b'abcdefghij')
+        files = StaticFiles(path, r'[a-z]+\.mp3', hot_file=hot.get, content_type='audio/mpeg')
+
+        async def run():
+            app = web.Application()
+            app.add_routes([web.get('/files/{file_name}', files.handle)])
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async def get(file_name, **headers):
+                        async with session.get(f'http://127.0.0.1:{port}/files/{file_name}', headers=headers) as r:
+                            return r.status, await r.read(), r.headers
+
+                    for file_name, data in [('hot.mp3', b'0123456789'), ('cold.mp3', b'abcdefghij')]:
+                        status, body, headers = await get(file_name)
+                        assert (status, body) == (200, data)
+                        assert headers['Content-Type'] == 'audio/mpeg'
+                        # newer aiohttp versions replace the ETag of a FileResponse with their own
+                        assert 'ETag' in headers
+                        assert (await get(file_name, Range='bytes=2-4'))[:2] == (206, data[2:5])
+                        assert (await get(file_name, Range='bytes=-3'))[:2] == (206, data[-3:])
+                        assert (await get(file_name, **{'If-None-Match': f'"{file_name}"'}))[0] == 304
+                    assert (await get('hot.mp3', Range='bytes=2-4', **{'If-Range': '"x"'}))[:2] == (200, b'0123456789')
+                    status, _, headers = await get('hot.mp3', Range='bytes=20-30')
+                    assert status == 416 and headers['Content-Range'] == 'bytes */10'
+                    assert (await get('missing.mp3'))[0] == 404
+                    assert (await get('..secret'))[0] == 404
+            finally:
+                await runner.cleanup()
+
+        asyncio.get_event_loop().run_until_complete(run())
+        stats = files.stats()
+        assert stats['hot'] == 5 and stats['sendfile'] == 3 and stats['not_modified'] == 2
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,203 @@
+import asyncio
+import collections
+import logging
+import sqlite3
+import threading
+from abc import ABCMeta, abstractmethod
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+history_writes = metrics.counter('notifybch_payment_history_writes_total', 'Payments written to the history.')
+
+# clustered by address and time, so a page of an address' history is one contiguous range scan;
+# a payment redelivered after a restart gets a new received_at, so it's UNIQUE that keeps it out
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS payments (
+    address BLOB NOT NULL,
+    received_at REAL NOT NULL,
+    tx_hash TEXT NOT NULL,
+    satoshis INTEGER NOT NULL,
+    fiat_amount REAL,
+    currency TEXT,
+    PRIMARY KEY (address, received_at, tx_hash),
+    UNIQUE (address, tx_hash)
+) WITHOUT ROWID
+'''
+_INSERT = 'INSERT OR IGNORE INTO payments VALUES (?, ?, ?, ?, ?, ?)'
+_SELECT = '''
+SELECT received_at, tx_hash, satoshis, fiat_amount, currency FROM payments
+WHERE address = ? AND received_at BETWEEN ? AND ? AND (received_at < ? OR tx_hash < ?)
+ORDER BY received_at DESC, tx_hash DESC LIMIT ?
+'''
+# sorts after every hex tx hash, so a cursor made of just a time includes everything at that time
+_AFTER_ALL_HASHES = 'g'
+
+
+class PaymentHistory(metaclass=ABCMeta):
+    @abstractmethod
+    def record(self, address_key: bytes, tx_hash: str, satoshis: int, fiat_amount: Optional[float],
+               currency: Optional[str], received_at: float) -> None:
+        pass
+
+    @abstractmethod
+    async def payments(self, address_key: bytes, before: Optional[Tuple[float, str]] = None,
+                       since: float = 0, limit: int = 100) -> List[Dict]:
+        """Newest first, strictly older than the (received_at, tx_hash) cursor before."""
+        pass
+
+    @abstractmethod
+    async def listen(self) -> None:
+        pass
+
+
+class PaymentHistorySqlite(PaymentHistory):
+    """
+    Payments in a SQLite table keyed by address and time. record only queues the payment; queued
+    payments are written in one transaction every flush_interval seconds, or as soon as
+    max_batch are queued, on a thread of their own. Reads go through a second connection, so a
+    process that never writes, such as a worker, can serve them too.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_batch: int = 1000,
+                 read_threads: int = 2) -> None:
+        self._path = path
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._pending: List[Tuple] = []
+        self._writing: List[Tuple] = []
+        self._flush_requested: asyncio.Event = None
+        self._write_executor = ThreadPoolExecutor(1)
+        self._read_executor = ThreadPoolExecutor(read_threads)
+        self._write_connection: sqlite3.Connection = None
+        self._read_connections = threading.local()
+        self._counts = collections.Counter()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(_SCHEMA)
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def record(self, address_key: bytes, tx_hash: str, satoshis: int, fiat_amount: Optional[float],
+               currency: Optional[str], received_at: float) -> None:
+        self._pending.append((address_key, received_at, tx_hash, satoshis, fiat_amount, currency))
+        if len(self._pending) >= self._max_batch and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def _write(self, rows: List[Tuple]) -> None:
+        if self._write_connection is None:
+            self._write_connection = self._connect()
+        with self._write_connection:
+            self._write_connection.executemany(_INSERT, rows)
+
+    async def flush(self) -> None:
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        self._writing = rows
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._write_executor, self._write, rows)
+        except sqlite3.Error:
+            self._counts['failed'] += len(rows)
+            logger.exception('could not write %d payments to %s', len(rows), self._path)
+            return
+        finally:
+            self._writing = []
+        history_writes.inc(len(rows))
+        self._counts['written'] += len(rows)
+        self._counts['batches'] += 1
+
+    async def listen(self) -> None:
+        self._flush_requested = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), self._flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_requested.clear()
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def _read(self, address_key: bytes, before: Tuple[float, str], since: float, limit: int) -> List[Tuple]:
+        connection = getattr(self._read_connections, 'connection', None)
+        if connection is None:
+            connection = self._read_connections.connection = self._connect()
+        before_time, before_hash = before
+        return connection.execute(_SELECT, (address_key, since, before_time, before_time, before_hash,
+                                            limit)).fetchall()
+
+    async def payments(self, address_key: bytes, before: Optional[Tuple[float, str]] = None,
+                       since: float = 0, limit: int = 100) -> List[Dict]:
+        before = before or (float('inf'), _AFTER_ALL_HASHES)
+        rows = await asyncio.get_event_loop().run_in_executor(self._read_executor, self._read,
+                                                              address_key, before, since, limit)
+        # payments not written yet are still answered, so a payment shows up as soon as it is notified
+        pending = [row[1:] for row in self._writing + self._pending
+                   if row[0] == address_key and since <= row[1] and (row[1], row[2]) < before]
+        if pending:
+            # the first copy of a redelivered payment wins, as it does once written
+            payments = {}
+            for row in sorted(set(rows) | set(pending)):
+                payments.setdefault(row[1], row)
+            rows = sorted(payments.values(), key=lambda row: (row[0], row[1]), reverse=True)[:limit]
+        return [
+            {'received_at': received_at, 'tx_hash': tx_hash, 'satoshis': satoshis,
+             'fiat_amount': fiat_amount, 'currency': currency}
+            for received_at, tx_hash, satoshis, fiat_amount, currency in rows
+        ]
+
+    def stats(self) -> Dict:
+        return {'pending': len(self._pending), **self._counts}
+
+
+def _test():
+    import os
+    import tempfile
+
+    async def run(path):
+        history = PaymentHistorySqlite(path, flush_interval=0.01, max_batch=3)
+        listening = asyncio.ensure_future(history.listen())
+        first, second = bytes(21), bytes([8]) + bytes(20)
+        for i in range(5):
+            history.record(first, f'{i:064x}', 1000 + i, i / 10, 'EUR', 100.0 + i)
+        history.record(first, f'{9:064x}', 9, None, None, 102.0)
+        history.record(second, f'{7:064x}', 7, 0.07, 'USD', 101.0)
+        # answered from the queue before anything is written
+        assert [p['satoshis'] for p in await history.payments(first, limit=2)] == [1004, 1003]
+        await asyncio.sleep(0.05)
+        assert history.stats()['pending'] == 0 and history.stats()['written'] == 7
+
+        page = await history.payments(first, limit=4)
+        assert [p['tx_hash'][-1] for p in page] == ['4', '3', '9', '2']
+        assert page[0] == {'received_at': 104.0, 'tx_hash': f'{4:064x}', 'satoshis': 1004,
+                           'fiat_amount': 0.4, 'currency': 'EUR'}
+        last = page[-1]
+        page = await history.payments(first, before=(last['received_at'], last['tx_hash']), limit=4)
+        assert [p['tx_hash'][-1] for p in page] == ['1', '0']
+        assert [p['satoshis'] for p in await history.payments(first, since=103)] == [1004, 1003]
+        assert [p['satoshis'] for p in await history.payments(second)] == [7]
+
+        # redelivered payments are stored once, even with a later time, as after a restart
+        history.record(second, f'{7:064x}', 7, 0.07, 'USD', 101.0)
+        history.record(second, f'{7:064x}', 7, 0.07, 'USD', 150.0)
+        assert [p['received_at'] for p in await history.payments(second)] == [101.0]
+        listening.cancel()
+        await asyncio.gather(listening, return_exceptions=True)
+        reader = PaymentHistorySqlite(path)
+        assert len(await reader.payments(second)) == 1
+        assert len(await reader.payments(first)) == 6
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(os.path.join(tmp_dir, 'payments.sqlite')))
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[None]], workers: int = 1,
+                 max_queue_size: int = 1000, drop_when_full: bool = False) -> None:
+        self._name = name
+        self._handler = handler
+        self._workers = workers
+        self._drop_when_full = drop_when_full
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._latencies = collections.deque(maxlen=1000)
+        self._counts = collections.Counter()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    async def put(self, item: Any) -> None:
+        entry = (asyncio.get_event_loop().time(), item)
+        if self._drop_when_full:
+            try:
+                self._queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                self._counts['dropped'] += 1
+                return
+        else:
+            if self._queue.full():
+                self._counts['blocked'] += 1
+            await self._queue.put(entry)
+        self._counts['queued'] += 1
+
+    async def run(self) -> None:
+        workers = [asyncio.ensure_future(self._worker()) for _ in range(self._workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self) -> None:
+        while True:
+            queued_at, item = await self._queue.get()
+            try:
+                await self._handler(item)
+                self._counts['processed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._counts['errors'] += 1
+                logger.exception('%s stage failed to process an item', self._name)
+            finally:
+                self._latencies.append(asyncio.get_event_loop().time() - queued_at)
+                self._queue.task_done()
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+        return {
+            'queue_depth': self._queue.qsize(),
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+            **self._counts,
+        }
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]) -> None:
+        self._stages = stages
+
+    async def run(self) -> None:
+        await asyncio.gather(*[stage.run() for stage in self._stages])
+
+    async def join(self) -> None:
+        for stage in self._stages:
+            await stage.join()
+
+    def stats(self) -> Dict[str, Dict]:
+        return {stage.name: stage.stats() for stage in self._stages}
+
+
+class Coalescer:
+    """
+    Collects items per key and hands them to flush as one batch once no new item arrived for
+    window seconds, and at the latest max_delay seconds after the first one.
+    """
+
+    def __init__(self, window: float, max_delay: float, flush: Callable[[Hashable, List], Awaitable[None]]) -> None:
+        self._window = window
+        self._max_delay = max_delay
+        self._flush = flush
+        self._pending = {}
+        self._flushing = set()
+        self._counts = collections.Counter()
+
+    def add(self, key: Hashable, item: Any) -> None:
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = [now, [], None]
+        else:
+            batch[2].cancel()
+        first_at, items, _ = batch
+        items.append(item)
+        batch[2] = loop.call_at(min(now + self._window, first_at + self._max_delay), self._flush_key, key)
+        self._counts['items'] += 1
+
+    def _flush_key(self, key: Hashable) -> None:
+        _, items, _ = self._pending.pop(key)
+        self._counts['batches'] += 1
+        future = asyncio.ensure_future(self._flush_batch(key, items))
+        self._flushing.add(future)
+        future.add_done_callback(self._flushing.discard)
+
+    async def _flush_batch(self, key: Hashable, items: List) -> None:
+        try:
+            await self._flush(key, items)
+        except Exception:
+            self._counts['errors'] += 1
+            logger.exception('failed to flush %d coalesced items', len(items))
+
+    async def join(self) -> None:
+        while self._pending or self._flushing:
+            if self._flushing:
+                await asyncio.wait(list(self._flushing))
+            else:
+                await asyncio.sleep(self._window)
+
+    def stats(self) -> Dict:
+        return {'pending': len(self._pending), **self._counts}
+
+
+def _test():
+    _test_coalescer()
+
+    async def run():
+        outputs = []
+        release = asyncio.Event()
+
+        async def double(item):
+            await second.put(item * 2)
+
+        async def collect(item):
+            await release.wait()
+            outputs.append(item)
+
+        first = Stage('double', double, workers=2, max_queue_size=2)
+        second = Stage('collect', collect, workers=1, max_queue_size=1, drop_when_full=True)
+        pipeline = Pipeline([first, second])
+        run_future = asyncio.ensure_future(pipeline.run())
+        for i in range(5):
+            await first.put(i)
+        await first.join()
+        release.set()
+        await pipeline.join()
+        run_future.cancel()
+
+        stats = pipeline.stats()
+        assert stats['double']['processed'] == 5
+        assert stats['collect']['processed'] + stats['collect']['dropped'] == 5
+        assert stats['collect']['dropped'] > 0
+        assert len(outputs) == stats['collect']['processed']
+        assert all(output % 2 == 0 for output in outputs)
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def _test_coalescer():
+    async def run():
+        flushed = []
+
+        async def flush(key, items):
+            flushed.append((key, items, asyncio.get_event_loop().time() - started))
+
+        coalescer = Coalescer(0.1, 0.27, flush)
+        started = asyncio.get_event_loop().time()
+        coalescer.add('a', 1)
+        coalescer.add('b', 1)
+        await asyncio.sleep(0.06)
+        coalescer.add('a', 2)
+        await asyncio.sleep(0.2)
+        # items every 0.06s keep extending the window until max_delay forces a flush
+        for i in range(7):
+            coalescer.add('c', i)
+            await asyncio.sleep(0.06)
+        await coalescer.join()
+
+        assert [(key, items) for key, items, _ in flushed] == [
+            ('b', [1]), ('a', [1, 2]), ('c', [0, 1, 2, 3, 4]), ('c', [5, 6]),
+        ]
+        assert flushed[1][2] >= 0.16
+        assert coalescer.stats() == {'pending': 0, 'items': 10, 'batches': 4}
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,77 @@
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, Tuple
+
+# record: little-endian float64 unix timestamp, uint32 payload length, raw SSE data (utf-8)
+_HEADER = struct.Struct('<dI')
+MAGIC = b'NBCHSSE1'
+
+
+class SseRecorder:
+    def __init__(self, path: str, flush_every: int = 100) -> None:
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if is_new:
+            self._file.write(MAGIC)
+        self._flush_every = flush_every
+        self._unflushed = 0
+
+    def record(self, data: str, timestamp: float = None) -> None:
+        payload = data.encode()
+        self._file.write(_HEADER.pack(time.time() if timestamp is None else timestamp, len(payload)))
+        self._file.write(payload)
+        self._unflushed += 1
+        if self._unflushed >= self._flush_every:
+            self._file.flush()
+            self._unflushed = 0
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_records(path: str) -> Iterator[Tuple[float, bytes]]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'Not an SSE recording: {path}')
+            offset = len(MAGIC)
+            size = len(mapped)
+            while offset + _HEADER.size <= size:
+                timestamp, length = _HEADER.unpack_from(mapped, offset)
+                offset += _HEADER.size
+                if offset + length > size:
+                    # last record was cut off while recording
+                    break
+                yield timestamp, mapped[offset:offset + length]
+                offset += length
+
+
+def _test():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'capture.sse')
+        recorder = SseRecorder(path)
+        recorder.record('{"type": "mempool", "data": []}', timestamp=10.0)
+        recorder.record('{"type": "block", "data": []}', timestamp=11.5)
+        recorder.close()
+        recorder = SseRecorder(path)
+        recorder.record('{"type": "mempool", "data": [1]}', timestamp=12.0)
+        recorder.close()
+        with open(path, 'ab') as f:
+            f.write(_HEADER.pack(13.0, 100) + b'{"type"')
+
+        records = [(timestamp, data.decode()) for timestamp, data in read_records(path)]
+        assert records == [
+            (10.0, '{"type": "mempool", "data": []}'),
+            (11.5, '{"type": "block", "data": []}'),
+            (12.0, '{"type": "mempool", "data": [1]}'),
+        ]
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,17 +1,32 @@
 import asyncio
+import hmac
+import html
+import logging
 import os
-import secrets
+import sys
+import time
 from string import Template
+from typing import Dict, List, Optional, Tuple
 
 from aiohttp import web
-import aiohttp
-import pickle
 
 from cashaddress.convert import Address
 from concurrent.futures.thread import ThreadPoolExecutor
 
+import address_registry
+import address_store
+import broadcast
 import exchange_rate
+import ipc
+import log
+import metrics
+import pages
+import notifier
+import payment_history
+import pipeline
+import seen
 import text_to_speech
+import tx_event
 import wallet
 from tx_event import TxBitsocket, Tx
 
@@ -19,20 +34,109 @@ app_auth = os.environ['ONESIGNAL_APP_KEY']
 app_id = os.environ['ONESIGNAL_APP_ID']
 addresses_path = os.environ.get('ADDRESSES_PATH', 'addresses.pickle')
 speech_path = os.environ.get('SPEECH_PATH', 'speech')
-
-try:
-    addresses = pickle.load(open(addresses_path, 'rb'))
-    if isinstance(addresses, set):
-        addresses = {address: {'currency': 'USD'} for address in addresses}
-except:
-    addresses = dict()
-address_websockets = dict()
-wallet = wallet.WalletDefault()
-wallet.add_addresses([Address.from_string(address) for address in addresses.keys()])
-exchange_rates = exchange_rate.ExchangeRateBitcoinCom()
+# compose payment announcements from a pre-rendered clip library instead of one synthesis call each
+speech_compose = os.environ.get('SPEECH_COMPOSE', '1') == '1'
+match_workers = int(os.environ.get('MATCH_WORKERS', '2'))
+fanout_workers = int(os.environ.get('FANOUT_WORKERS', '16'))
+pipeline_queue_size = int(os.environ.get('PIPELINE_QUEUE_SIZE', '10000'))
+pipeline_drop_when_full = os.environ.get('PIPELINE_DROP_WHEN_FULL', '') == '1'
+# merge payments to the same address that arrive within NOTIFY_COALESCE_WINDOW seconds of each other
+# into one push and one speech clip, delaying the first by at most NOTIFY_COALESCE_MAX_DELAY; 0 disables
+notify_coalesce_window = float(os.environ.get('NOTIFY_COALESCE_WINDOW', '0'))
+notify_coalesce_max_delay = float(os.environ.get('NOTIFY_COALESCE_MAX_DELAY', '2'))
+websocket_heartbeat = float(os.environ.get('WEBSOCKET_HEARTBEAT', '30'))
+port = int(os.environ.get('PORT', '7010'))
+# WORKERS > 0 runs one ingester process that owns the Bitsocket subscription and
+# WORKERS HTTP/websocket processes sharing the port, connected over a Unix socket.
+workers = int(os.environ.get('WORKERS', '0'))
+role = os.environ.get('ROLE', 'ingester' if workers > 0 else 'single')
+ipc_path = os.environ.get('IPC_PATH', 'ingester.sock')
+# the ingester serves no pages, so its own /metrics (matching, notifications, rates) listens here; 0 disables it
+ingester_metrics_port = int(os.environ.get('INGESTER_METRICS_PORT', str(port + 1)))
+log_level = os.environ.get('LOG_LEVEL', 'INFO')
+# record raw Bitsocket messages to a file, or replay such a file instead of connecting to Bitsocket
+record_path = os.environ.get('BITSOCKET_RECORD_PATH')
+replay_path = os.environ.get('BITSOCKET_REPLAY_PATH')
+replay_realtime = os.environ.get('REPLAY_REALTIME', '1') == '1'
+replay_speed = float(os.environ.get('REPLAY_SPEED', '1'))
+# host:port of a local node's raw tx feed, used instead of Bitsocket
+rawtx_address = os.environ.get('RAWTX_ADDRESS')
+# payments already handled are skipped when Bitsocket redelivers txs after a reconnect;
+# SEEN_FILTER=bloom bounds the memory at the cost of rare false positives
+seen_filter = os.environ.get('SEEN_FILTER', 'expiring')
+seen_ttl = float(os.environ.get('SEEN_TTL', '21600'))
+seen_path = os.environ.get('SEEN_PATH')
+exchange_rates_path = os.environ.get('EXCHANGE_RATES_PATH', 'exchange_rates.pickle')
+# POST /subscribe and /unsubscribe take many addresses at once and require an
+# "Authorization: Bearer <token>" header; without BULK_API_TOKEN they are disabled
+bulk_api_token = os.environ.get('BULK_API_TOKEN')
+bulk_max_addresses = int(os.environ.get('BULK_MAX_ADDRESSES', '10000'))
+# every matched payment is kept here and served by /history/{address}; workers read the same file
+payment_history_path = os.environ.get('PAYMENT_HISTORY_PATH', 'payments.sqlite')
+history_max_page_size = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '1000'))
+
+logger = logging.getLogger('notifybch')
+sse_message_to_match = metrics.histogram('notifybch_sse_message_to_match_seconds',
+                                         'Time from reading a tx off the SSE stream until its outputs are matched.')
+blocks_processed = metrics.counter('notifybch_blocks_processed_total',
+                                   'Block events matched against the watched addresses.')
+block_payments = metrics.counter('notifybch_block_payments_total', 'Payments to watched addresses found in blocks.')
+
+
+addresses_store = address_store.AddressStoreLog(addresses_path)
+addresses = address_registry.AddressRegistry()
+# a store that can't be read stops the start, rather than dropping every subscriber; workers only read
+# it, since the ingester may be appending to it
+stored_addresses = addresses_store.load(repair=role != 'worker')
+for address in addresses.load(stored_addresses):
+    logger.warning('ignoring invalid address in registry: %s', address)
+del stored_addresses
 currency_infos = exchange_rate.CurrenciesInfoFixed()
-speech = text_to_speech.TextToSpeech(speech_path)
-pool = ThreadPoolExecutor(10)
+history = payment_history.PaymentHistorySqlite(payment_history_path)
+if role == 'worker':
+    ingester = ipc.IpcClient(ipc_path, on_connect=lambda: [{'type': 'watch', 'address': address}
+                                                           for address in address_websockets.keys()])
+    address_websockets = broadcast.BroadcastHub(
+        on_first_client=lambda address: ingester.send({'type': 'watch', 'address': address}),
+        on_last_client=lambda address: ingester.send({'type': 'unwatch', 'address': address}),
+    )
+else:
+    if role == 'ingester':
+        address_websockets = ipc.IpcServer(ipc_path, lambda event: receive_worker_message(event))
+    else:
+        address_websockets = broadcast.BroadcastHub()
+    if replay_path is not None:
+        wallet = wallet.WalletReplay(replay_path, realtime=replay_realtime, speed=replay_speed)
+    elif rawtx_address is not None:
+        rawtx_host, rawtx_port = rawtx_address.rsplit(':', 1)
+        wallet = wallet.WalletRawTx(rawtx_host, int(rawtx_port))
+    else:
+        wallet = wallet.WalletDefault(record_path=record_path)
+    wallet.add_address_keys(addresses.keys_raw())
+    # Coinbase takes part as bitcoin.com's bulk source, so it isn't polled twice
+    exchange_rates = exchange_rate.ExchangeRateComposite(
+        [exchange_rate.ExchangeRateBitcoinCom(
+            demand=lambda: {record.get('currency', 'USD') for record in addresses.distinct_records()},
+            bulk_source=exchange_rate.ExchangeRateApi(),
+        )],
+        fallback=exchange_rate.ExchangeRateFixed(),
+        path=exchange_rates_path,
+    )
+    speech = text_to_speech.TextToSpeech(speech_path)
+    notifications = notifier.NotifierOneSignal(app_id, app_auth)
+    if seen_filter == 'bloom':
+        seen_payments = seen.SeenBloom(ttl=seen_ttl, path=seen_path)
+    else:
+        seen_payments = seen.SeenExpiring(ttl=seen_ttl, path=seen_path)
+    pool = ThreadPoolExecutor(10)
+    if speech_compose:
+        speech_composer = text_to_speech.SpeechComposer(speech, speech_path, pool, currency_infos)
+        speech_cache = text_to_speech.SpeechCache(speech_composer, speech_path, pool)
+    else:
+        speech_cache = text_to_speech.SpeechCache(speech, speech_path, pool)
+# workers share the speech directory with the ingester but not its memory, so they always read from disk
+speech_files = pages.StaticFiles(speech_path, r'[0-9a-f]{32}\.mp3', content_type='audio/mpeg',
+                                 hot_file=speech_cache.hot_file if role != 'worker' else None)
 
 
 def format_bch_amount(satoshis: int):
@@ -61,96 +165,465 @@ def format_fiat_amount(satoshis: int, currency: str) -> str:
 
 
 def format_fiat_speech(satoshis: int, currency: str):
+    # the currency code rather than the symbol, which is ambiguous; SpeechComposer picks its clip by the code
+    # and TextToSpeech says the spoken name instead
     sats_per_usd = exchange_rates.for_currency(currency)
     fmt = currency_infos.format_for_code(currency)
     amount = satoshis / sats_per_usd
-    symbol = currency_infos.symbol_for_code(currency)
-    return '{:.{n}f} {}'.format(amount, symbol, n=fmt['decimalPlaces'])
+    return '{:.{n}f} {}'.format(amount, currency, n=fmt['decimalPlaces'])
+
+
+def fiat_value(satoshis: int, currency: str) -> Optional[float]:
+    try:
+        sats_per_unit = exchange_rates.for_currency(currency)
+    except KeyError:
+        return None
+    return round(satoshis / sats_per_unit, currency_infos.format_for_code(currency)['decimalPlaces'])
+
+
+def min_satoshis(record: Dict) -> int:
+    """The subscriber's minimum amount in satoshis, converted at the cached rate when it is set in fiat."""
+    min_amount = record.get('min_amount')
+    if not min_amount:
+        return 0
+    min_currency = record.get('min_currency', 'BCH')
+    if min_currency == 'BCH':
+        return round(min_amount * 100_000_000)
+    try:
+        # a threshold is still useful with ExchangeRateFixed's old rates, an amount shown to the merchant isn't
+        return round(min_amount * exchange_rates.approximate_for_currency(min_currency))
+    except KeyError:
+        # a payment that can't be compared is not held back
+        return 0
+
+
+def wants_payment(record: Dict, satoshis: int) -> bool:
+    return (record.get('push', True) or record.get('speech', True)) and satoshis >= min_satoshis(record)
+
+
+def payments_summary(count: int, amount_text: str) -> str:
+    if count == 1:
+        return f'Received {amount_text}'
+    return f'Received {count} payments, total {amount_text}'
 
 
-async def tx_speech(address: str, satoshis: int, currency: str):
-    wss = address_websockets.get(address, {})
-    if not wss:
+async def tx_speech(address: str, satoshis: int, currency: str, count: int = 1):
+    if not address_websockets.has_clients(address):
         return
-    txt = f'Received {format_fiat_speech(satoshis, currency)}'
-    _, handle_id = address.split(':')
-    await asyncio.get_event_loop().run_in_executor(pool, lambda: speech.gen_speech(handle_id, txt))
-    await asyncio.gather(*[
-        ws.send_str(f'/speech/{handle_id}.mp3')
-        for ws in wss.values()
-    ])
+    try:
+        txt = payments_summary(count, format_fiat_speech(satoshis, currency))
+    except KeyError:
+        txt = payments_summary(count, format_bch_amount(satoshis))
+    file_name = await speech_cache.speech_file(txt)
+    address_websockets.broadcast(address, f'/speech/{file_name}')
+
+
+def match_block(txs: List[Tx]) -> Dict[str, List[Tuple[str, int]]]:
+    """Payments per address in a whole block, found with one intersection against the watched keys."""
+    outputs = tx_event.block_outputs(txs)
+    watched = wallet.listening_keys({key for _, key, _ in outputs})
+    if not watched:
+        return {}
+    amounts = {}
+    for tx, key, amount in outputs:
+        if key in watched:
+            payment = (address_registry.cash_address(key), tx.tx_hash())
+            amounts[payment] = amounts.get(payment, 0) + amount
+    payments = {}
+    for (bch_address, tx_hash), amount in amounts.items():
+        payments.setdefault(bch_address, []).append((tx_hash, amount))
+    return payments
 
 
-async def receive_tx(tx: Tx):
+def match_tx(tx: Tx) -> Dict[str, int]:
     amounts = {}
     for output in tx.outputs():
-        address = output.address()
-        if address is not None and wallet.is_listening_to_address(address):
-            amounts.setdefault(address.cash_address(), 0)
-            amounts[address.cash_address()] += output.amount()
-    print(amounts)
-    async with aiohttp.ClientSession() as session:
-        for bch_address, amount in amounts.items():
-            currency = addresses[bch_address]['currency']
-            asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(tx_speech(bch_address, amount, currency)))
-            url = 'https://explorer.bitcoin.com/bch/tx/' + tx.tx_hash()
-            msg = f'Received {format_fiat_amount(amount, currency)} ({format_bch_amount(amount)})'
-            async with session.post(
-                    'https://onesignal.com/api/v1/notifications',
-                    headers={"Authorization": f'Basic {app_auth}'},
-                    json={
-                        "app_id": app_id,
-                        # "included_segments": ["All"],
-                        "contents": {"en": msg},
-                        "url": url,
-                        "filters": [
-                            {"field": "tag", "key": "bchAddress", "relation": "=", "value": bch_address},
-                        ],
-                    },
-            ) as resp:
-                print(resp.status)
-                print(await resp.text())
+        key = output.address_key()
+        if key is not None and wallet.is_listening_to_key(key):
+            bch_address = 'bitcoincash:' + output.raw_address()
+            amounts[bch_address] = amounts.get(bch_address, 0) + output.amount()
+    return amounts
+
+
+def payments_url(bch_address: str, payments: List[Tuple[str, int]]) -> str:
+    if len(payments) == 1:
+        return 'https://explorer.bitcoin.com/bch/tx/' + payments[0][0]
+    return 'https://explorer.bitcoin.com/bch/address/' + bch_address
+
+
+def notification_amount(satoshis: int, currency: str) -> str:
+    try:
+        return f'{format_fiat_amount(satoshis, currency)} ({format_bch_amount(satoshis)})'
+    except KeyError:
+        # no source has ever had a rate for this currency, which only happens on a first start
+        logger.warning('no exchange rate for %s, notifying without it', currency)
+        return format_bch_amount(satoshis)
+
+
+async def notify_payments(bch_address: str, payments: List[Tuple[str, int]]):
+    record = addresses.get(bch_address)
+    if record is None:
+        # unsubscribed while its payments were waiting to be coalesced or fanned out
+        logger.debug('dropping payments to %s, which is no longer subscribed', bch_address)
+        return
+    currency = record['currency']
+    amount = sum(payment_amount for _, payment_amount in payments)
+    if record.get('push', True):
+        msg = payments_summary(len(payments), notification_amount(amount, currency))
+        notifications.notify(bch_address, msg, payments_url(bch_address, payments))
+    if record.get('speech', True):
+        await tx_speech(bch_address, amount, currency, len(payments))
+
+
+async def receive_tx(tx: Tx, received_at: float = None):
+    amounts = match_tx(tx)
+    if received_at is not None:
+        sse_message_to_match.observe(asyncio.get_event_loop().time() - received_at)
+    if amounts:
+        logger.debug('tx %s matched %s', tx.tx_hash(), amounts)
+    for bch_address, amount in amounts.items():
+        if seen_payments.check_and_add((tx.tx_hash(), bch_address)):
+            logger.debug('tx %s to %s was already processed', tx.tx_hash(), bch_address)
+            continue
+        record = addresses.get(bch_address)
+        if record is None:
+            continue
+        currency = record['currency']
+        history.record(address_registry.address_key(bch_address), tx.tx_hash(), amount,
+                       fiat_value(amount, currency), currency, time.time())
+        # filtered here, so a payment below the subscriber's minimum never costs a push or a synthesis
+        if not wants_payment(record, amount):
+            logger.debug('tx %s to %s is below the minimum or muted', tx.tx_hash(), bch_address)
+            continue
+        if notify_coalesce_window > 0:
+            payment_coalescer.add(bch_address, (tx.tx_hash(), amount))
+        else:
+            await fanout_stage.put((bch_address, [(tx.tx_hash(), amount)]))
+
+
+def confirmations_summary(count: int, amount_text: str) -> str:
+    if count == 1:
+        return f'Confirmed {amount_text}'
+    return f'Confirmed {count} payments, total {amount_text}'
+
+
+def receive_block(txs: List[Tx], height: Optional[int]):
+    confirmed = match_block(txs)
+    for bch_address, payments in confirmed.items():
+        record = addresses[bch_address]
+        if not record.get('push', True):
+            continue
+        minimum = min_satoshis(record)
+        # Bitsocket redelivers a block after a reconnect just like mempool txs
+        payments = [(tx_hash, amount) for tx_hash, amount in payments
+                    if amount >= minimum
+                    and not seen_payments.check_and_add((f'{tx_hash}:confirmed', bch_address))]
+        if not payments:
+            continue
+        amount = sum(payment_amount for _, payment_amount in payments)
+        msg = confirmations_summary(len(payments), notification_amount(amount, record['currency']))
+        if height is not None:
+            msg += f' in block {height:,}'
+        # one notification per address and block, however many of its payments the block confirms
+        notifications.notify(bch_address, msg, payments_url(bch_address, payments))
+    blocks_processed.inc()
+    block_payments.inc(sum(len(payments) for payments in confirmed.values()))
+
+
+async def receive_tx_dict(item):
+    received_at, tx_dict = item
+    # raw tx feeds hand over parsed transactions, Bitsocket hands over dicts
+    await receive_tx(tx_dict if isinstance(tx_dict, Tx) else TxBitsocket(tx_dict), received_at)
+
+
+async def fanout_payments(item):
+    await notify_payments(*item)
+
+
+match_stage = pipeline.Stage('match', receive_tx_dict, workers=match_workers,
+                             max_queue_size=pipeline_queue_size, drop_when_full=pipeline_drop_when_full)
+fanout_stage = pipeline.Stage('fanout', fanout_payments, workers=fanout_workers,
+                              max_queue_size=pipeline_queue_size)
+tx_pipeline = pipeline.Pipeline([match_stage, fanout_stage])
+payment_coalescer = pipeline.Coalescer(notify_coalesce_window, notify_coalesce_max_delay,
+                                       lambda bch_address, payments: fanout_stage.put((bch_address, payments)))
+
+metrics.gauge('notifybch_registered_addresses', 'Addresses in the subscription registry.', lambda: len(addresses))
+if role != 'worker':
+    metrics.gauge('notifybch_watched_addresses', 'Addresses the wallet listens to.',
+                  lambda: wallet.address_count())
+    metrics.gauge('notifybch_notification_queue_depth', 'Notifications waiting to be sent.',
+                  lambda: notifications.queue_depth())
+    metrics.gauge('notifybch_coalescing_addresses', 'Addresses with payments waiting to be merged.',
+                  lambda: payment_coalescer.stats()['pending'])
+    metrics.gauge('notifybch_seen_hit_rate', 'Share of matched payments skipped as already processed.',
+                  lambda: seen_payments.hit_rate())
+    metrics.gauge('notifybch_exchange_rate_fallbacks', 'Rate lookups no source could answer right away.',
+                  lambda: exchange_rates.stats()['fallbacks'])
+    metrics.gauge('notifybch_exchange_rate_max_staleness_seconds', 'Age of the oldest rate the sources hold.',
+                  lambda: exchange_rates.stats()['max_staleness'] or 0)
+    for stage in (match_stage, fanout_stage):
+        metrics.gauge(f'notifybch_pipeline_{stage.name}_queue_depth', f'Items waiting in the {stage.name} stage.',
+                      lambda stage=stage: stage.stats()['queue_depth'])
+if role != 'ingester':
+    metrics.gauge('notifybch_open_websockets', 'Open websocket connections.',
+                  lambda: address_websockets.client_count())
+    metrics.gauge('notifybch_websocket_dropped_messages', 'Websocket messages dropped for slow or dead clients.',
+                  lambda: address_websockets.stats().get('dropped', 0))
 
 
 async def listen_txs():
     async for message in wallet.listen():
-        if message['type'] == 'mempool' and len(message['data']) > 0:
+        if message['type'] == 'mempool':
+            received_at = asyncio.get_event_loop().time()
             for tx_dict in message['data']:
-                await receive_tx(TxBitsocket(tx_dict))
+                await match_stage.put((received_at, tx_dict))
+        elif message['type'] == 'block':
+            # a malformed block must not end the listener, which also carries the mempool txs
+            try:
+                txs = [tx_dict if isinstance(tx_dict, Tx) else TxBitsocket(tx_dict) for tx_dict in message['data']]
+                receive_block(txs, message.get('index'))
+            except Exception:
+                logger.exception('could not process block %s', message.get('index'))
+        else:
+            logger.warning('unknown message type: %s', message['type'])
+
+
+def register_address(address: str, record: Dict):
+    register_addresses({address: record})
+
+
+def register_addresses(records: Dict[str, Dict]):
+    """One wallet update, one store write and one message to the other processes for all records."""
+    new_keys = [address_registry.address_key(address) for address in records if address not in addresses]
+    for address, record in records.items():
+        addresses[address] = record
+    if role == 'worker':
+        ingester.send({'type': 'register', 'records': records})
+        return
+    wallet.add_address_keys(new_keys)
+    asyncio.ensure_future(addresses_store.save_many(records))
+    if role == 'ingester':
+        address_websockets.publish({'type': 'addresses', 'records': records})
+
+
+def unregister_addresses(bch_addresses: List[str]):
+    removed = [address for address in dict.fromkeys(bch_addresses) if address in addresses]
+    for address in removed:
+        del addresses[address]
+    if role == 'worker':
+        ingester.send({'type': 'unregister', 'addresses': bch_addresses})
+        return
+    wallet.remove_address_keys(address_registry.address_key(address) for address in removed)
+    asyncio.ensure_future(addresses_store.remove_many(removed))
+    if role == 'ingester':
+        address_websockets.publish({'type': 'unregistered', 'addresses': removed})
+
+
+def receive_worker_message(event: Dict):
+    if event['type'] == 'register':
+        records = {address: record for address, record in event['records'].items()
+                   if address_registry.address_key(address) is not None}
+        if len(records) < len(event['records']):
+            logger.warning('worker registered invalid addresses: %s', sorted(set(event['records']) - set(records)))
+        register_addresses(records)
+    elif event['type'] == 'unregister':
+        unregister_addresses(event['addresses'])
+    else:
+        logger.warning('unknown worker message: %s', event)
+
+
+async def listen_ingester():
+    async for event in ingester.listen():
+        if event['type'] == 'speech':
+            address_websockets.broadcast(event['address'], event['message'])
+        elif event['type'] == 'addresses':
+            for address, record in event['records'].items():
+                addresses[address] = record
+        elif event['type'] == 'unregistered':
+            for address in event['addresses']:
+                addresses.pop(address, None)
         else:
-            print('unknown message type:', message)
+            logger.warning('unknown ingester message: %s', event)
+
+
+async def supervise_worker(worker_id: int):
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env={**os.environ, 'ROLE': 'worker', 'IPC_PATH': os.path.abspath(ipc_path)},
+        )
+        return_code = await process.wait()
+        logger.warning('worker %d exited with %s, restarting', worker_id, return_code)
+        await asyncio.sleep(1)
 
 
-def save_addresses():
-    pickle.dump(addresses, open(addresses_path, 'wb'))
+def start_ingestion():
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(tx_pipeline.run()))
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(listen_txs()))
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(exchange_rates.listen()))
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(notifications.listen()))
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(seen_payments.listen()))
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(history.listen()))
+    if speech_compose:
+        asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(speech_composer.prepare()))
 
 
-asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(listen_txs()))
-asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(exchange_rates.listen()))
+async def save_state(app):
+    seen_payments.save()
+    exchange_rates.save()
+    await history.flush()
+
+
+def render_currency_links(selected_currency: str = None) -> str:
+    selected_html = 'class="selected"'
+    return '\n'.join(
+        f'<a href="/subscribe/select-currency/{pages.slot("address")}/{currency}"'
+        f'{selected_html if selected_currency == currency else ""}>'
+        f'{currency}&nbsp;({currency_infos.symbol_for_code(currency)})'
+        f'</a>'
+        for currency in currency_infos.currencies()
+    )
 
 
-template = Template(open('subscribe.html').read())
-scan_template = open('scan.html').read()
+template = pages.SplicedTemplate(Template(open('subscribe.html').read()), {'appId': app_id}, ['address', 'currency'])
+scan_page = pages.CachedPage(open('scan.html').read(), cache_control='public, max-age=86400',
+                             last_modified=pages.STARTED).precompress()
 currency_template = Template(open('select_currency.html').read())
+currency_pages = {
+    selected_currency: pages.SplicedTemplate(currency_template,
+                                             {'currencies': render_currency_links(selected_currency)},
+                                             ['address', 'minAmount', 'minCurrencies', 'push', 'speech'])
+    for selected_currency in [None, *currency_infos.currencies()]
+}
+page_cache = pages.PageCache()
 
 
 async def handle(request):
     try:
         address = request.match_info.get('address', '<no address provided>')
         if address not in addresses:
-            wallet.add_addresses([Address.from_string(address)])
-            addresses[address] = {'currency': 'USD'}
-            save_addresses()
+            Address.from_string(address)
+            register_address(address, {'currency': 'USD'})
     except:
         return web.Response(text=f'Invalid address: {address}')
-    return web.Response(
-        text=template.substitute(address=address, appId=app_id, currency=addresses[address]['currency']),
-        content_type='text/html',
-    )
+    currency = addresses[address]['currency']
+    page = page_cache.get(('subscribe', address, currency),
+                          lambda: template.render(address=html.escape(address), currency=html.escape(currency)))
+    return page.response(request)
+
+
+async def read_bulk_addresses(request) -> List:
+    authorization = request.headers.get('Authorization', '')
+    if bulk_api_token is None:
+        raise web.HTTPForbidden(text='The bulk API is disabled')
+    # bytes, since compare_digest refuses str with non-ASCII characters
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {bulk_api_token}'.encode()):
+        raise web.HTTPUnauthorized(text='Missing or invalid bulk API token')
+    try:
+        items = (await request.json())['addresses']
+    except web.HTTPException:
+        # such as 413 for a body over client_max_size
+        raise
+    except Exception:
+        raise web.HTTPBadRequest(text='Expected a JSON object with an "addresses" list')
+    if not isinstance(items, list):
+        raise web.HTTPBadRequest(text='Expected a JSON object with an "addresses" list')
+    if len(items) > bulk_max_addresses:
+        raise web.HTTPRequestEntityTooLarge(max_size=bulk_max_addresses, actual_size=len(items),
+                                            text=f'At most {bulk_max_addresses} addresses per request')
+    return items
+
+
+async def handle_bulk_subscribe(request):
+    items = await read_bulk_addresses(request)
+    currencies = set(currency_infos.currencies())
+    records = {}
+    errors = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'address': item}
+        address = item.get('address') if isinstance(item, dict) else None
+        key = address_registry.address_key(address) if isinstance(address, str) else None
+        if key is None:
+            errors.append({'index': index, 'address': address, 'error': 'invalid address'})
+            continue
+        currency = item.get('currency', 'USD')
+        if not isinstance(currency, str) or currency not in currencies:
+            errors.append({'index': index, 'address': address, 'error': f'unknown currency: {currency}'})
+            continue
+        address = address_registry.cash_address(key)
+        records[address] = {**addresses.get(address, {}), 'currency': currency}
+    if records:
+        register_addresses(records)
+    return web.json_response({'registered': len(records), 'errors': errors})
+
+
+async def handle_bulk_unsubscribe(request):
+    items = await read_bulk_addresses(request)
+    bch_addresses = {}
+    errors = []
+    for index, address in enumerate(items):
+        key = address_registry.address_key(address) if isinstance(address, str) else None
+        if key is None:
+            errors.append({'index': index, 'address': address, 'error': 'invalid address'})
+        elif not addresses.has_key(key):
+            errors.append({'index': index, 'address': address, 'error': 'not subscribed'})
+        else:
+            bch_addresses[address_registry.cash_address(key)] = None
+    if bch_addresses:
+        unregister_addresses(list(bch_addresses))
+    return web.json_response({'unregistered': len(bch_addresses), 'errors': errors})
+
+
+async def handle_history(request):
+    address = request.match_info['address']
+    key = address_registry.address_key(address)
+    if key is None:
+        return web.Response(text=f'Invalid address: {address}', status=400)
+    try:
+        limit = min(int(request.query.get('limit', '100')), history_max_page_size)
+        since = float(request.query.get('since', '0'))
+        before = None
+        if 'before' in request.query:
+            before_time, before_hash = request.query['before'].split(':', 1)
+            before = float(before_time), before_hash
+    except ValueError:
+        return web.Response(text='Invalid limit, since or before', status=400)
+    if limit < 1:
+        return web.Response(text='Invalid limit, since or before', status=400)
+    payments = await history.payments(key, before=before, since=since, limit=limit)
+    # the cursor is the last payment on the page, which the next page starts strictly after
+    last = payments[-1] if len(payments) == limit else None
+    return web.json_response({
+        'address': address_registry.cash_address(key),
+        'payments': payments,
+        'next': f'{last["received_at"]!r}:{last["tx_hash"]}' if last is not None else None,
+    })
+
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.REGISTRY.render(), content_type='text/plain')
 
 
 async def handle_scan(request):
-    return web.Response(text=scan_template, content_type='text/html')
+    return scan_page.response(request)
+
+
+def render_select_currency(address: str) -> str:
+    record = addresses.get(address, {})
+    min_currency = record.get('min_currency', 'BCH')
+    return currency_pages.get(record.get('currency'), currency_pages[None]).render(
+        address=html.escape(address),
+        minAmount=f'{record["min_amount"]:g}' if 'min_amount' in record else '',
+        minCurrencies='\n'.join(
+            f'<option value="{html.escape(currency)}"{" selected" if currency == min_currency else ""}>'
+            f'{html.escape(currency)}</option>'
+            for currency in dict.fromkeys(['BCH', record.get('currency', 'USD'), min_currency])
+        ),
+        push='checked' if record.get('push', True) else '',
+        speech='checked' if record.get('speech', True) else '',
+    )
 
 
 async def handle_select_currency(request):
@@ -161,24 +634,46 @@ async def handle_select_currency(request):
         return web.Response(text=f'Invalid address: {address}')
     if 'currency' in request.match_info:
         currency = request.match_info['currency']
-        addresses.setdefault(address, {})['currency'] = currency
-        save_addresses()
-    selected_currency = addresses.get(address, {}).get('currency', None)
-    selected_html = 'class="selected"'
-    response = currency_template.substitute(
-        currencies='\n'.join(
-            f'<a href="/subscribe/select-currency/{address}/{currency}"'
-            f'{selected_html if selected_currency == currency else ""}>'
-            f'{currency}&nbsp;({currency_infos.symbol_for_code(currency)})'
-            f'</a>'
-            for currency in currency_infos.currencies()
-        ),
-        address=address,
-    )
-    return web.Response(
-        text=response,
-        content_type='text/html',
-    )
+        if currency not in currency_infos.currencies():
+            return web.Response(text=f'Unknown currency: {currency}', status=400)
+        register_address(address, {**addresses.get(address, {}), 'currency': currency})
+    record = addresses.get(address, {})
+    page = page_cache.get(('select-currency', address, tuple(sorted(record.items()))),
+                          lambda: render_select_currency(address))
+    return page.response(request)
+
+
+async def handle_select_preferences(request):
+    try:
+        address = request.match_info.get('address', '<no address provided>')
+        address = Address.from_string(address).cash_address()
+    except:
+        return web.Response(text=f'Invalid address: {address}', status=400)
+    form = await request.post()
+    record = {'currency': 'USD', **addresses.get(address, {})}
+    for name in ('min_amount', 'min_currency', 'push', 'speech'):
+        record.pop(name, None)
+    min_amount = form.get('min_amount', '').strip()
+    if min_amount:
+        try:
+            min_amount = float(min_amount)
+        except ValueError:
+            min_amount = -1
+        if not 0 <= min_amount < float('inf'):
+            return web.Response(text=f'Invalid minimum amount: {form["min_amount"]}', status=400)
+        min_currency = form.get('min_currency', 'BCH')
+        if min_currency != 'BCH' and min_currency not in currency_infos.currencies():
+            return web.Response(text=f'Invalid currency: {min_currency}', status=400)
+        if min_amount > 0:
+            record['min_amount'] = min_amount
+            record['min_currency'] = min_currency
+    # only settings that differ from the defaults are stored, so most subscribers still share one record
+    if 'push' not in form:
+        record['push'] = False
+    if 'speech' not in form:
+        record['speech'] = False
+    register_address(address, record)
+    return await handle_select_currency(request)
 
 
 async def websocket_handler(request):
@@ -188,26 +683,59 @@ async def websocket_handler(request):
     except:
         return web.Response(text=f'Invalid address: {address}', status=400)
 
-    ws_id = secrets.token_urlsafe(32)
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(heartbeat=websocket_heartbeat)
     await ws.prepare(request)
 
-    address_websockets.setdefault(address, {})[ws_id] = ws
+    await address_websockets.serve(address, ws)
 
-    async for _ in ws:
-        pass
-
-    print('websocket connection closed', address, ws_id)
-    del address_websockets[address][ws_id]
+    logger.debug('websocket connection closed %s', address)
 
     return ws
 
 
 app = web.Application()
 app.add_routes([web.get('/', handle_scan),
+                web.get('/metrics', handle_metrics),
                 web.get('/select-currency/{address}', handle_select_currency),
                 web.get('/select-currency/{address}/{currency}', handle_select_currency),
+                web.post('/select-currency/{address}', handle_select_preferences),
                 web.get('/listen-tx/{address}', websocket_handler),
+                web.get('/history/{address}', handle_history),
+                web.post('/subscribe', handle_bulk_subscribe),
+                web.post('/unsubscribe', handle_bulk_unsubscribe),
+                web.get('/speech/{file_name}', speech_files.handle),
                 web.get('/{address}', handle)])
-
-web.run_app(app, port=7010)
+metrics_app = web.Application()
+metrics_app.add_routes([web.get('/metrics', handle_metrics)])
+
+
+async def start_metrics_listener():
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, port=ingester_metrics_port).start()
+    logger.info('ingester metrics on port %d', ingester_metrics_port)
+
+
+if __name__ == '__main__':
+    log.setup_logging(log_level)
+    asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(metrics.monitor_event_loop_lag()))
+    if role == 'worker':
+        asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(listen_ingester()))
+        web.run_app(app, port=port, reuse_port=True)
+    elif role == 'ingester':
+        start_ingestion()
+        asyncio.get_event_loop().run_until_complete(address_websockets.start())
+        if ingester_metrics_port:
+            asyncio.get_event_loop().run_until_complete(start_metrics_listener())
+        for i in range(workers):
+            asyncio.ensure_future(supervise_worker(i))
+        try:
+            asyncio.get_event_loop().run_forever()
+        finally:
+            seen_payments.save()
+            exchange_rates.save()
+            asyncio.get_event_loop().run_until_complete(history.flush())
+    else:
+        start_ingestion()
+        app.on_cleanup.append(save_state)
+        web.run_app(app, port=port)
@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import math
+import os
+import pickle
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Hashable, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+seen_checks = metrics.counter('notifybch_seen_checks_total', 'Payments checked against the seen filter.')
+seen_hits = metrics.counter('notifybch_seen_hits_total', 'Payments skipped because they were already processed.')
+
+
+class Seen(metaclass=ABCMeta):
+    @abstractmethod
+    def check_and_add(self, key: Tuple[str, str]) -> bool:
+        """Whether key was seen within the ttl; marks it as seen either way."""
+        pass
+
+    @abstractmethod
+    def save(self) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict:
+        pass
+
+
+def _write_atomically(path: str, state) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def _read(path: Optional[str], kind: str):
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            saved_kind, state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception('could not read seen filter from %s, starting empty', path)
+        return None
+    if saved_kind != kind:
+        logger.warning('seen filter in %s is a %s filter, not %s; starting empty', path, saved_kind, kind)
+        return None
+    return state
+
+
+class SeenBase(Seen):
+    KIND = None
+
+    def __init__(self, path: Optional[str], save_interval: float) -> None:
+        self._path = path
+        self._save_interval = save_interval
+        self._counts = collections.Counter()
+
+    def check_and_add(self, key: Tuple[str, str]) -> bool:
+        seen_checks.inc()
+        self._counts['checks'] += 1
+        if self._check_and_add(key, time.time()):
+            seen_hits.inc()
+            self._counts['hits'] += 1
+            return True
+        return False
+
+    @abstractmethod
+    def _check_and_add(self, key: Hashable, now: float) -> bool:
+        pass
+
+    @abstractmethod
+    def _state(self):
+        pass
+
+    def save(self) -> None:
+        if self._path is not None:
+            _write_atomically(self._path, (self.KIND, self._state()))
+
+    async def listen(self) -> None:
+        if self._path is None:
+            return
+        while True:
+            await asyncio.sleep(self._save_interval)
+            state = self._state()
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, _write_atomically, self._path, (self.KIND, state))
+            except OSError:
+                logger.exception('could not save seen filter to %s', self._path)
+
+    def hit_rate(self) -> float:
+        return self._counts['hits'] / self._counts['checks'] if self._counts['checks'] else 0.0
+
+    def stats(self) -> Dict:
+        return {'hit_rate': self.hit_rate(), **self._counts}
+
+
+class SeenExpiring(SeenBase):
+    """
+    Exact set of keys, each forgotten ttl seconds after it was first seen or once more than
+    max_entries keys are held, oldest first.
+    """
+    KIND = 'expiring'
+
+    def __init__(self, ttl: float = 6 * 3600, max_entries: int = 1_000_000, path: str = None,
+                 save_interval: float = 60) -> None:
+        super().__init__(path, save_interval)
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict(_read(path, self.KIND) or ())
+        self._expire(time.time())
+
+    def _expire(self, now: float) -> None:
+        while self._entries:
+            key, seen_at = next(iter(self._entries.items()))
+            if now - seen_at < self._ttl and len(self._entries) <= self._max_entries:
+                break
+            del self._entries[key]
+
+    def _check_and_add(self, key: Hashable, now: float) -> bool:
+        self._expire(now)
+        if key in self._entries:
+            return True
+        self._entries[key] = now
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return False
+
+    def _state(self):
+        return list(self._entries.items())
+
+    def stats(self) -> Dict:
+        return {**super().stats(), 'size': len(self._entries)}
+
+
+class SeenBloom(SeenBase):
+    """
+    Two generations of Bloom filters, each sized for capacity keys at the given false positive
+    rate. The older generation is dropped every ttl seconds, so a key is remembered for
+    between ttl and 2 * ttl seconds in constant memory. A false positive skips a payment.
+    """
+    KIND = 'bloom'
+
+    def __init__(self, ttl: float = 6 * 3600, capacity: int = 1_000_000, error_rate: float = 1e-6,
+                 path: str = None, save_interval: float = 60) -> None:
+        super().__init__(path, save_interval)
+        self._ttl = ttl
+        self._bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        state = _read(path, self.KIND)
+        if state is not None and state[0] == (self._bits, self._hashes):
+            _, self._rotated_at, current, previous = state
+            self._current, self._previous = bytearray(current), bytearray(previous)
+        else:
+            self._rotated_at = time.time()
+            self._current = bytearray((self._bits + 7) // 8)
+            self._previous = bytearray((self._bits + 7) // 8)
+
+    def _positions(self, key: Hashable):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self._bits for i in range(self._hashes)]
+
+    def _check_and_add(self, key: Hashable, now: float) -> bool:
+        if now - self._rotated_at >= self._ttl:
+            # after a long pause both generations are stale
+            self._previous = self._current if now - self._rotated_at < 2 * self._ttl else bytearray(len(self._current))
+            self._current = bytearray(len(self._current))
+            self._rotated_at = now
+        positions = self._positions(key)
+        current, previous = self._current, self._previous
+        if all(current[position >> 3] & (1 << (position & 7)) for position in positions):
+            return True
+        seen = all(previous[position >> 3] & (1 << (position & 7)) for position in positions)
+        for position in positions:
+            current[position >> 3] |= 1 << (position & 7)
+        return seen
+
+    def _state(self):
+        return (self._bits, self._hashes), self._rotated_at, bytes(self._current), bytes(self._previous)
+
+    def stats(self) -> Dict:
+        return {**super().stats(), 'bytes': len(self._current) + len(self._previous)}
+
+
+def _test():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for make in [lambda **kwargs: SeenExpiring(max_entries=3, **kwargs),
+                     lambda **kwargs: SeenBloom(capacity=100, **kwargs)]:
+            path = os.path.join(tmp_dir, 'seen.pickle')
+            seen = make(path=path)
+            assert not seen.check_and_add(('tx1', 'bitcoincash:a'))
+            assert not seen.check_and_add(('tx1', 'bitcoincash:b'))
+            assert seen.check_and_add(('tx1', 'bitcoincash:a'))
+            assert seen.stats()['hits'] == 1 and seen.hit_rate() == 1 / 3
+            seen.save()
+
+            restored = make(path=path)
+            assert restored.check_and_add(('tx1', 'bitcoincash:b'))
+            assert not restored.check_and_add(('tx2', 'bitcoincash:a'))
+            os.remove(path)
+
+        expiring = SeenExpiring(ttl=0.05, max_entries=2)
+        expiring.check_and_add(('tx1', 'a'))
+        expiring.check_and_add(('tx2', 'a'))
+        expiring.check_and_add(('tx3', 'a'))
+        assert not expiring.check_and_add(('tx1', 'a'))
+        time.sleep(0.06)
+        assert not expiring.check_and_add(('tx3', 'a'))
+
+        bloom = SeenBloom(ttl=0.05, capacity=100)
+        bloom.check_and_add(('tx1', 'a'))
+        time.sleep(0.06)
+        assert bloom.check_and_add(('tx1', 'a'))
+        time.sleep(0.11)
+        assert not bloom.check_and_add(('tx1', 'a'))
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,24 +1,456 @@
-from google.cloud import texttospeech
+import asyncio
+import collections
+import hashlib
+import logging
 import os
+import re
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
+
+import exchange_rate
+import metrics
+
+logger = logging.getLogger(__name__)
+synthesis_duration = metrics.histogram('notifybch_speech_synthesis_seconds',
+                                       'Duration of a speech synthesis call, including writing the file.')
+speech_composed = metrics.counter('notifybch_speech_composed_total', 'Speech clips composed from the clip library.')
+speech_fallbacks = metrics.counter('notifybch_speech_fallbacks_total',
+                                   'Speech clips synthesized remotely because they could not be composed.')
+
+# layer III bitrates in kbit/s and sample rates in Hz, by the MPEG version bits of the frame header
+_MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+_ONES = ('zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen '
+         'seventeen eighteen nineteen').split()
+_TENS = ('', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety')
+_SCALES = ((1_000_000_000, 'billion'), (1_000_000, 'million'), (1000, 'thousand'))
+# the text tx_speech produces, e.g. 'Received 12.50 EUR' or 'Received 3 payments, total 1200 JPY'
+_SPEECH_TEXT = re.compile(r'Received (?:(\d+) payments, total )?(\d+)(?:\.(\d+))? ([A-Z]{3})')
+
+# currency names as said after an amount; CurrenciesInfo's names are meant for lists, like "Korea (South) Won"
+_SPOKEN_CURRENCY_NAMES = {
+    'USD': 'US dollars', 'GBP': 'British pounds', 'CAD': 'Canadian dollars', 'EUR': 'euros',
+    'HKD': 'Hong Kong dollars', 'JPY': 'yen', 'KRW': 'South Korean won', 'NZD': 'New Zealand dollars',
+    'SEK': 'Swedish kronor', 'CHF': 'Swiss francs', 'ALL': 'Albanian lek', 'AFN': 'afghanis',
+    'ARS': 'Argentine pesos', 'AWG': 'Aruban florins', 'AUD': 'Australian dollars', 'AZN': 'Azerbaijani manat',
+    'BSD': 'Bahamian dollars', 'BBD': 'Barbadian dollars', 'BYN': 'Belarusian rubles', 'BZD': 'Belize dollars',
+    'BMD': 'Bermudian dollars', 'BOB': 'bolivianos', 'BAM': 'convertible marks', 'BWP': 'pula',
+    'BGN': 'Bulgarian lev', 'BRL': 'Brazilian reais', 'BND': 'Brunei dollars', 'KHR': 'Cambodian riel',
+    'KYD': 'Cayman Islands dollars', 'CLP': 'Chilean pesos', 'CNY': 'yuan', 'COP': 'Colombian pesos',
+    'CRC': 'Costa Rican colones', 'HRK': 'Croatian kuna', 'CUP': 'Cuban pesos', 'CZK': 'Czech korunas',
+    'DKK': 'Danish kroner', 'DOP': 'Dominican pesos', 'XCD': 'East Caribbean dollars', 'EGP': 'Egyptian pounds',
+    'SVC': 'Salvadoran colones', 'FKP': 'Falkland Islands pounds', 'FJD': 'Fijian dollars', 'GHS': 'Ghanaian cedis',
+    'GIP': 'Gibraltar pounds', 'GTQ': 'quetzales', 'GGP': 'Guernsey pounds', 'GYD': 'Guyanese dollars',
+    'HNL': 'lempiras', 'HUF': 'forints', 'ISK': 'Icelandic kronur', 'INR': 'Indian rupees',
+    'IDR': 'rupiah', 'IRR': 'Iranian rials', 'IMP': 'Manx pounds', 'ILS': 'shekels',
+    'JMD': 'Jamaican dollars', 'JEP': 'Jersey pounds', 'KZT': 'tenge', 'KPW': 'North Korean won',
+    'KGS': 'Kyrgyz som', 'LAK': 'kip', 'LBP': 'Lebanese pounds', 'LRD': 'Liberian dollars',
+    'MKD': 'Macedonian denars', 'MYR': 'ringgit', 'MUR': 'Mauritian rupees', 'MXN': 'Mexican pesos',
+    'MNT': 'tugriks', 'MZN': 'meticais', 'NAD': 'Namibian dollars', 'NPR': 'Nepalese rupees',
+    'ANG': 'Netherlands Antillean guilders', 'NIO': 'cordobas', 'NGN': 'naira', 'NOK': 'Norwegian kroner',
+    'OMR': 'Omani rials', 'PKR': 'Pakistani rupees', 'PAB': 'balboas', 'PYG': 'guaranies',
+    'PEN': 'soles', 'PHP': 'Philippine pesos', 'PLN': 'zloty', 'QAR': 'Qatari riyals',
+    'RON': 'Romanian lei', 'RUB': 'Russian rubles', 'SHP': 'Saint Helena pounds', 'SAR': 'Saudi riyals',
+    'RSD': 'Serbian dinars', 'SCR': 'Seychellois rupees', 'SGD': 'Singapore dollars', 'SBD': 'Solomon Islands dollars',
+    'SOS': 'Somali shillings', 'ZAR': 'rand', 'LKR': 'Sri Lankan rupees', 'SRD': 'Surinamese dollars',
+    'SYP': 'Syrian pounds', 'TWD': 'New Taiwan dollars', 'THB': 'baht', 'TTD': 'Trinidad and Tobago dollars',
+    'TRY': 'Turkish lira', 'UAH': 'hryvnias', 'UYU': 'Uruguayan pesos', 'UZS': 'Uzbek som',
+    'VEF': 'bolivars', 'VND': 'dong', 'YER': 'Yemeni rials',
+}
+
+
+def spoken_text(text: str) -> str:
+    """A payment announcement with its currency code replaced by the spoken name."""
+    match = _SPEECH_TEXT.fullmatch(text)
+    if match is None or match.group(4) not in _SPOKEN_CURRENCY_NAMES:
+        return text
+    return text[:match.start(4)] + _SPOKEN_CURRENCY_NAMES[match.group(4)]
 
 
 class TextToSpeech:
-    def __init__(self, path: str):
+    def __init__(self, path: str, language_code: str = 'en-US'):
         os.makedirs(path, exist_ok=True)
         self._path = path
-        self._client = texttospeech.TextToSpeechClient()
+        self._language_code = language_code
+        self._client = None
 
-    def gen_speech(self, handle_id: str, text: str):
-        synthesis_input = texttospeech.types.SynthesisInput(text=text)
+    def voice_key(self) -> str:
+        return f'{self._language_code}/NEUTRAL/MP3'
+
+    def synthesize(self, text: str) -> bytes:
+        # google-cloud-texttospeech takes about half a second to import, so it's only loaded once needed
+        from google.cloud import texttospeech
+
+        # announcements carry the currency code for SpeechComposer, which read out would be spelled
+        synthesis_input = texttospeech.types.SynthesisInput(text=spoken_text(text))
         voice = texttospeech.types.VoiceSelectionParams(
-            language_code='en-US',
+            language_code=self._language_code,
             ssml_gender=texttospeech.enums.SsmlVoiceGender.NEUTRAL)
 
         audio_config = texttospeech.types.AudioConfig(
             audio_encoding=texttospeech.enums.AudioEncoding.MP3)
 
+        if self._client is None:
+            self._client = texttospeech.TextToSpeechClient()
         response = self._client.synthesize_speech(synthesis_input, voice, audio_config)
+        return response.audio_content
+
+    def gen_speech(self, handle_id: str, text: str):
         path = os.path.join(self._path, f'{handle_id}.mp3')
 
         with open(path, 'wb') as f:
-            f.write(response.audio_content)
+            f.write(self.synthesize(text))
+
+
+def mp3_frames(data: bytes) -> bytes:
+    """
+    The audio frames of an mp3 file without ID3 tags or a Xing/Info header frame, so that clips
+    encoded with the same settings can be concatenated into one playable file.
+    """
+    offset = 0
+    if data[:3] == b'ID3':
+        offset = 10 + (data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]) + (10 if data[5] & 0x10 else 0)
+    frames = []
+    while offset + 4 <= len(data) and data[offset] == 0xff and data[offset + 1] & 0xe0 == 0xe0:
+        version = (data[offset + 1] >> 3) & 3
+        layer = (data[offset + 1] >> 1) & 3
+        bitrate_index = data[offset + 2] >> 4
+        sample_rate_index = (data[offset + 2] >> 2) & 3
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            raise ValueError(f'unsupported mp3 frame header at offset {offset}')
+        length = ((144 if version == 3 else 72) * _MP3_BITRATES[version][bitrate_index] * 1000
+                  // _MP3_SAMPLE_RATES[version][sample_rate_index] + ((data[offset + 2] >> 1) & 1))
+        frame = data[offset:offset + length]
+        if frames or not (b'Xing' in frame[:64] or b'Info' in frame[:64]):
+            frames.append(frame)
+        offset += length
+    return b''.join(frames)
+
+
+def number_words(n: int) -> List[str]:
+    if n < 20:
+        return [_ONES[n]]
+    if n < 100:
+        return [_TENS[n // 10]] + ([_ONES[n % 10]] if n % 10 else [])
+    if n < 1000:
+        return [_ONES[n // 100], 'hundred'] + (number_words(n % 100) if n % 100 else [])
+    for scale, name in _SCALES:
+        if n >= scale:
+            return number_words(n // scale) + [name] + (number_words(n % scale) if n % scale else [])
+
+
+class SpeechComposer:
+    """
+    Speaks payment announcements by concatenating pre-rendered clips: "Received", number words
+    and currency names, rendered once per voice by the remote TextToSpeech. Anything else, or
+    anything before the clip library is ready, is synthesized remotely as before.
+    """
+
+    def __init__(self, speech: TextToSpeech, path: str, executor: Executor,
+                 currencies_info: exchange_rate.CurrenciesInfo, max_concurrency: int = 4) -> None:
+        self._speech = speech
+        self._path = os.path.join(path, 'clips', hashlib.sha256(speech.voice_key().encode()).hexdigest()[:16])
+        self._executor = executor
+        self._currencies_info = currencies_info
+        self._max_concurrency = max_concurrency
+        self._clips: Dict[str, bytes] = {}
+        self._counts = collections.Counter()
+
+    def voice_key(self) -> str:
+        return f'{self._speech.voice_key()}/composed'
+
+    def clip_texts(self) -> Dict[str, str]:
+        texts = {word: word for word in [*_ONES, *_TENS[2:], 'hundred', *(name for _, name in _SCALES),
+                                         'point', 'payments', 'total']}
+        texts['received'] = 'Received'
+        for currency in self._currencies_info.currencies():
+            texts[f'currency-{currency}'] = _SPOKEN_CURRENCY_NAMES.get(
+                currency, self._currencies_info.name_for_code(currency))
+        return texts
+
+    def clip_names(self, text: str) -> Optional[List[str]]:
+        match = _SPEECH_TEXT.fullmatch(text)
+        if match is None:
+            return None
+        count, whole, fraction, currency = match.groups()
+        if int(whole) >= 1000 * _SCALES[0][0] or (count is not None and int(count) >= 1000 * _SCALES[0][0]):
+            return None
+        names = ['received']
+        if count is not None:
+            names += number_words(int(count)) + ['payments', 'total']
+        names += number_words(int(whole))
+        if fraction:
+            names += ['point'] + [_ONES[int(digit)] for digit in fraction]
+        return names + [f'currency-{currency}']
+
+    def compose(self, text: str) -> Optional[bytes]:
+        names = self.clip_names(text)
+        if names is None or any(name not in self._clips for name in names):
+            return None
+        return b''.join([self._clips[name] for name in names])
+
+    def synthesize(self, text: str) -> bytes:
+        audio = self.compose(text)
+        if audio is not None:
+            speech_composed.inc()
+            self._counts['composed'] += 1
+            return audio
+        speech_fallbacks.inc()
+        self._counts['fallbacks'] += 1
+        return self._speech.synthesize(text)
+
+    def _render_clip(self, name: str, text: str) -> None:
+        # named after the text too, so a clip whose wording changed is rendered again
+        path = os.path.join(self._path, f'{name}-{hashlib.sha256(text.encode()).hexdigest()[:8]}.mp3')
+        if not os.path.exists(path):
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self._speech.synthesize(text))
+            os.replace(tmp_path, path)
+        with open(path, 'rb') as f:
+            self._clips[name] = mp3_frames(f.read())
+
+    async def prepare(self) -> None:
+        os.makedirs(self._path, exist_ok=True)
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        async def render(name, text):
+            async with semaphore:
+                try:
+                    await asyncio.get_event_loop().run_in_executor(self._executor, self._render_clip, name, text)
+                except Exception:
+                    logger.exception('could not render speech clip %s', name)
+
+        await asyncio.gather(*[render(name, text) for name, text in self.clip_texts().items()])
+        logger.info('speech clip library ready with %d clips', len(self._clips))
+
+    def stats(self) -> Dict:
+        return {'clips': len(self._clips), **self._counts}
+
+
+class SpeechCache:
+    def __init__(self, speech: TextToSpeech, path: str, executor: Executor,
+                 max_bytes: int = 200 * 1024 * 1024, max_hot_bytes: int = 8 * 1024 * 1024) -> None:
+        os.makedirs(path, exist_ok=True)
+        self._speech = speech
+        self._path = path
+        self._executor = executor
+        self._max_bytes = max_bytes
+        self._max_hot_bytes = max_hot_bytes
+        self._files = collections.OrderedDict()
+        self._total_bytes = 0
+        # contents of the most recently written files, which every listener fetches right away
+        self._hot = collections.OrderedDict()
+        self._hot_bytes = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._latencies = collections.deque(maxlen=1000)
+        self._counts = collections.Counter()
+        self._load_index()
+
+    def _load_index(self) -> None:
+        entries = []
+        for entry in os.scandir(self._path):
+            if entry.is_file() and entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, file_name, size in sorted(entries):
+            self._files[file_name] = size
+            self._total_bytes += size
+
+    def file_name_for_text(self, text: str) -> str:
+        key = hashlib.sha256(f'{self._speech.voice_key()}\n{text}'.encode()).hexdigest()[:32]
+        return f'{key}.mp3'
+
+    async def speech_file(self, text: str) -> str:
+        file_name = self.file_name_for_text(text)
+        if file_name in self._files:
+            self._files.move_to_end(file_name)
+            self._counts['hits'] += 1
+            return file_name
+        if file_name in self._in_flight:
+            self._counts['shared'] += 1
+            return await asyncio.shield(self._in_flight[file_name])
+        self._counts['misses'] += 1
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[file_name] = future
+        try:
+            started = asyncio.get_event_loop().time()
+            audio_content = await asyncio.get_event_loop().run_in_executor(
+                self._executor, self._synthesize_to_file, file_name, text)
+            self._latencies.append(asyncio.get_event_loop().time() - started)
+            synthesis_duration.observe(self._latencies[-1])
+            self._files[file_name] = len(audio_content)
+            self._total_bytes += len(audio_content)
+            self._remember_hot(file_name, audio_content)
+            self._evict()
+            future.set_result(file_name)
+        except BaseException as e:
+            future.set_exception(e)
+            # mark as retrieved so waiter-less failures aren't reported as never retrieved
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[file_name]
+        return file_name
+
+    def _synthesize_to_file(self, file_name: str, text: str) -> bytes:
+        audio_content = self._speech.synthesize(text)
+        path = os.path.join(self._path, file_name)
+        # written under a temporary name and renamed, so the file is never served half written
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(audio_content)
+        os.replace(tmp_path, path)
+        return audio_content
+
+    def _remember_hot(self, file_name: str, audio_content: bytes) -> None:
+        self._hot[file_name] = audio_content
+        self._hot_bytes += len(audio_content)
+        while self._hot_bytes > self._max_hot_bytes and self._hot:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_bytes -= len(evicted)
+
+    def hot_file(self, file_name: str) -> Optional[bytes]:
+        return self._hot.get(file_name)
+
+    def _evict(self) -> None:
+        while self._total_bytes > self._max_bytes and len(self._files) > 1:
+            file_name, size = self._files.popitem(last=False)
+            self._total_bytes -= size
+            evicted = self._hot.pop(file_name, None)
+            if evicted is not None:
+                self._hot_bytes -= len(evicted)
+            try:
+                os.remove(os.path.join(self._path, file_name))
+            except FileNotFoundError:
+                pass
+            self._counts['evicted'] += 1
+
+    def stats(self) -> Dict:
+        lookups = self._counts['hits'] + self._counts['shared'] + self._counts['misses']
+        latencies = sorted(self._latencies)
+        return {
+            'files': len(self._files),
+            'bytes': self._total_bytes,
+            'hot_files': len(self._hot),
+            'hit_rate': (self._counts['hits'] + self._counts['shared']) / lookups if lookups else None,
+            'synthesis_latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'synthesis_latency_max': latencies[-1] if latencies else None,
+            **self._counts,
+        }
+
+
+def _test():
+    import tempfile
+    import threading
+    import time
+    from concurrent.futures.thread import ThreadPoolExecutor
+
+    class TextToSpeechFake:
+        def __init__(self):
+            self.calls = []
+            self._lock = threading.Lock()
+
+        def voice_key(self):
+            return 'fake'
+
+        def synthesize(self, text):
+            with self._lock:
+                self.calls.append(text)
+            time.sleep(0.05)
+            return text.encode() * 10
+
+    async def run(path):
+        fake = TextToSpeechFake()
+        cache = SpeechCache(fake, path, ThreadPoolExecutor(4), max_bytes=300)
+        file_names = await asyncio.gather(*[cache.speech_file('Received 5.00 $') for _ in range(5)])
+        assert len(set(file_names)) == 1
+        assert fake.calls == ['Received 5.00 $']
+        with open(os.path.join(path, file_names[0]), 'rb') as f:
+            assert f.read() == b'Received 5.00 $' * 10
+
+        assert await cache.speech_file('Received 5.00 $') == file_names[0]
+        assert len(fake.calls) == 1
+        assert cache.hot_file(file_names[0]) == b'Received 5.00 $' * 10
+        await cache.speech_file('Received 6.00 $')
+        await cache.speech_file('Received 7.00 $')
+        assert not os.path.exists(os.path.join(path, file_names[0]))
+        assert cache.hot_file(file_names[0]) is None
+        stats = cache.stats()
+        assert stats['misses'] == 3 and stats['hits'] == 1 and stats['shared'] == 4
+        assert stats['evicted'] == 1
+
+        reloaded = SpeechCache(fake, path, ThreadPoolExecutor(1), max_bytes=300)
+        assert reloaded.stats()['files'] == 2
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(tmp_dir))
+    _test_composer()
+
+
+def _test_mp3(text: str, frames: int = 3) -> bytes:
+    # ID3 tag, Info header frame and audio frames of 24 kHz 32 kbit/s mono MPEG 2 layer III, 96 bytes each
+    header = b'\xff\xf3\x44\xc4'
+    tag = b'ID3\x04\x00\x00\x00\x00\x00\x05' + b'\x00' * 5
+    info = header + b'\x00' * 32 + b'Info' + b'\x00' * 56
+    payload = text.encode()[:92].ljust(92, b'.')
+    return tag + info + (header + payload) * frames
+
+
+def _test_composer():
+    import tempfile
+    from concurrent.futures.thread import ThreadPoolExecutor
+
+    class TextToSpeechFake:
+        def __init__(self):
+            self.calls = []
+
+        def voice_key(self):
+            return 'fake'
+
+        def synthesize(self, text):
+            self.calls.append(text)
+            return _test_mp3(text)
+
+    assert mp3_frames(_test_mp3('Received')) == (b'\xff\xf3\x44\xc4' + b'Received'.ljust(92, b'.')) * 3
+    assert spoken_text('Received 3 payments, total 12.50 EUR') == 'Received 3 payments, total 12.50 euros'
+    assert spoken_text('Received 0.001 BCH') == 'Received 0.001 BCH'
+    assert number_words(1_200_015) == ['one', 'million', 'two', 'hundred', 'thousand', 'fifteen']
+
+    async def run(path):
+        fake = TextToSpeechFake()
+        composer = SpeechComposer(fake, path, ThreadPoolExecutor(2), exchange_rate.CurrenciesInfoFixed())
+        assert composer.synthesize('Received 12.50 EUR') == _test_mp3('Received 12.50 EUR')
+        assert fake.calls == ['Received 12.50 EUR']
+
+        await composer.prepare()
+        rendered = len(fake.calls)
+        audio = composer.synthesize('Received 3 payments, total 12.50 EUR')
+        assert len(fake.calls) == rendered
+        assert mp3_frames(audio) == audio
+        first_frames = [audio[i:i + 96] for i in range(0, len(audio), 96 * 3)]
+        assert [frame[4:].rstrip(b'.').decode() for frame in first_frames] == [
+            'Received', 'three', 'payments', 'total', 'twelve', 'point', 'five', 'zero', 'euros',
+        ]
+        assert composer.synthesize('Received 5 $') == _test_mp3('Received 5 $')
+        currency_texts = [text for name, text in composer.clip_texts().items() if name.startswith('currency-')]
+        assert len(currency_texts) == len(list(exchange_rate.CurrenciesInfoFixed().currencies()))
+        assert set(currency_texts) <= set(_SPOKEN_CURRENCY_NAMES.values())
+        assert composer.stats()['composed'] == 1 and composer.stats()['fallbacks'] == 2
+
+        reloaded = SpeechComposer(fake, path, ThreadPoolExecutor(2), exchange_rate.CurrenciesInfoFixed())
+        await reloaded.prepare()
+        assert len(fake.calls) == rendered + 1
+        assert reloaded.synthesize('Received 3 payments, total 12.50 EUR') == audio
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(tmp_dir))
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,10 +1,16 @@
+import hashlib
+import struct
 from abc import ABCMeta, abstractmethod
-from typing import Iterable, Dict
+from typing import Iterable, Dict, List, Optional, Tuple, Union
 
 from cashaddress.convert import Address
 
+import address_registry
+
 
 class TxOutput(metaclass=ABCMeta):
+    __slots__ = ()
+
     @abstractmethod
     def amount(self) -> int:
         pass
@@ -13,8 +19,18 @@ class TxOutput(metaclass=ABCMeta):
     def address(self) -> Address:
         pass
 
+    @abstractmethod
+    def raw_address(self) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def address_key(self) -> Optional[bytes]:
+        pass
+
 
 class Tx(metaclass=ABCMeta):
+    __slots__ = ()
+
     @abstractmethod
     def tx_hash(self) -> str:
         pass
@@ -31,6 +47,8 @@ class TxEventReceiver(metaclass=ABCMeta):
 
 
 class TxBitsocket(Tx):
+    __slots__ = ('_tx_dict',)
+
     def __init__(self, tx_dict: Dict) -> None:
         self._tx_dict = tx_dict
 
@@ -41,8 +59,14 @@ class TxBitsocket(Tx):
         for output_dict in self._tx_dict['out']:
             yield TxOutputBitsocket(output_dict)
 
+    def raw_outputs(self) -> List[Tuple[Optional[str], int]]:
+        """(prefix-less cashaddr or None, amount) of every output, without wrapping each one."""
+        return [(output_dict['e'].get('a'), output_dict['e']['v']) for output_dict in self._tx_dict['out']]
+
 
 class TxOutputBitsocket(TxOutput):
+    __slots__ = ('_output_dict',)
+
     def __init__(self, output_dict: Dict) -> None:
         self._output_dict = output_dict
 
@@ -54,9 +78,116 @@ class TxOutputBitsocket(TxOutput):
             return Address.from_string('bitcoincash:' + self._output_dict['e']['a'])
         return None
 
+    def raw_address(self) -> Optional[str]:
+        return self._output_dict['e'].get('a')
 
-def _test():
-    bitsocket_event = {
+    def address_key(self) -> Optional[bytes]:
+        base_addr = self._output_dict['e'].get('a')
+        return address_registry.raw_key(base_addr) if base_addr is not None else None
+
+
+_VALUE = struct.Struct('<q')
+_P2PKH_PREFIX, _P2PKH_SUFFIX = b'\x76\xa9\x14', b'\x88\xac'
+_P2SH_PREFIX, _P2SH_SUFFIX = b'\xa9\x14', b'\x87'
+
+
+def _read_varint(data: memoryview, offset: int) -> Tuple[int, int]:
+    first = data[offset]
+    if first < 0xfd:
+        return first, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[first]
+    return int.from_bytes(data[offset + 1:offset + 1 + size], 'little'), offset + 1 + size
+
+
+class TxRaw(Tx):
+    """
+    Serialized transaction as sent by a node. Nothing is copied or decoded up front: outputs
+    are located on demand and read straight out of the buffer.
+    """
+    __slots__ = ('_data', '_outputs_offset')
+
+    def __init__(self, data: Union[bytes, memoryview]) -> None:
+        self._data = memoryview(data)
+        self._outputs_offset = None
+
+    def tx_hash(self) -> str:
+        return hashlib.sha256(hashlib.sha256(self._data).digest()).digest()[::-1].hex()
+
+    def _skip_inputs(self) -> int:
+        data = self._data
+        n_inputs, offset = _read_varint(data, 4)
+        for _ in range(n_inputs):
+            script_len, offset = _read_varint(data, offset + 36)
+            offset += script_len + 4
+        return offset
+
+    def outputs(self) -> Iterable[TxOutput]:
+        if self._outputs_offset is None:
+            self._outputs_offset = self._skip_inputs()
+        data = self._data
+        n_outputs, offset = _read_varint(data, self._outputs_offset)
+        for _ in range(n_outputs):
+            script_len, script_offset = _read_varint(data, offset + 8)
+            yield TxOutputRaw(data, offset, script_offset, script_offset + script_len)
+            offset = script_offset + script_len
+
+
+class TxOutputRaw(TxOutput):
+    __slots__ = ('_data', '_offset', '_script_offset', '_script_end')
+
+    def __init__(self, data: memoryview, offset: int, script_offset: int, script_end: int) -> None:
+        self._data = data
+        self._offset = offset
+        self._script_offset = script_offset
+        self._script_end = script_end
+
+    def amount(self) -> int:
+        return _VALUE.unpack_from(self._data, self._offset)[0]
+
+    def script(self) -> memoryview:
+        return self._data[self._script_offset:self._script_end]
+
+    def address_key(self) -> Optional[bytes]:
+        data, start, end = self._data, self._script_offset, self._script_end
+        if end - start == 25 and data[start:start + 3] == _P2PKH_PREFIX and data[end - 2:end] == _P2PKH_SUFFIX:
+            return b'\x00' + data[start + 3:start + 23].tobytes()
+        if end - start == 23 and data[start:start + 2] == _P2SH_PREFIX and data[end - 1:end] == _P2SH_SUFFIX:
+            return b'\x08' + data[start + 2:start + 22].tobytes()
+        return None
+
+    def raw_address(self) -> Optional[str]:
+        key = self.address_key()
+        return address_registry.raw_address(key) if key is not None else None
+
+    def address(self) -> Address:
+        key = self.address_key()
+        return Address.from_string(address_registry.cash_address(key)) if key is not None else None
+
+
+def block_outputs(txs: Iterable[Tx]) -> List[List]:
+    """
+    [tx, address key, amount] for every output of txs. The addresses of all Bitsocket outputs
+    are decoded in one batch rather than output by output.
+    """
+    outputs = []
+    base_addr_indices = []
+    base_addrs = []
+    for tx in txs:
+        if isinstance(tx, TxBitsocket):
+            for base_addr, amount in tx.raw_outputs():
+                if base_addr is not None:
+                    base_addr_indices.append(len(outputs))
+                    base_addrs.append(base_addr)
+                outputs.append([tx, None, amount])
+        else:
+            outputs.extend([tx, output.address_key(), output.amount()] for output in tx.outputs())
+    for i, key in zip(base_addr_indices, address_registry.raw_keys(base_addrs)):
+        outputs[i][1] = key
+    return outputs
+
+
+def _test_event() -> Dict:
+    return {
         'type': 'mempool',
         'data': [
             {
@@ -133,7 +264,33 @@ def _test():
             }
         ]
     }
-    tx_dict = bitsocket_event['data'][0]
+
+
+def _test_raw_tx() -> str:
+    # the serialized form of the transaction in _test_event
+    return (
+        '01000000026fcc06f62ddfcdaa2cf5ff77f6ad134c342cddb4c716cc8f16e23e2a726368db010000006b483045022100ec4b628f3b'
+        '0ab7cf926e951b6ef93dfbdc93c9552578ffe370000b6df9e41b51022027371df9fdc9e1d91ed6e200aa020dd5f1132332760c7a4b'
+        '7be155c201fc557c412102272251131bb24991487471372f38b413e3743b3b1fcd9a8cf5aefcdcf8de6e4cfeffffff9c29d6498cbd'
+        '0b91298a42c06119f64eae0e6fe49a20319ce92e3739c08b9a2a010000006a47304402202cda403f967e36bd311665a615933346'
+        '696502854a43d517cd013860cf0f559302202b7910111d1f5041e965595302df474bb7cc17c519e8b39f36ea62286ef19cef412103'
+        'bab8c6f2af59de6cbc87f04710f0a1fa271fba6f45f08401c04246d64340b1dafeffffff02408995000000000017a9142e48498c77'
+        '87140cd964500a65d1d9dfa72eed6d87f81b1000000000001976a914aac3fc73678facd553f190fc0839f86b12f48be488acdcbb0800'
+    )
+
+
+def _build_raw_tx(outputs: Iterable[Tuple[int, bytes]], tx_id: int = 0) -> bytes:
+    # a transaction spending a single made-up input, for tests and benchmarks
+    serialized = struct.pack('<iB', 1, 1) + tx_id.to_bytes(32, 'little') + b'\0\0\0\0\0\xff\xff\xff\xff'
+    outputs = list(outputs)
+    serialized += bytes([len(outputs)]) if len(outputs) < 0xfd else b'\xfd' + len(outputs).to_bytes(2, 'little')
+    for value, script in outputs:
+        serialized += _VALUE.pack(value) + bytes([len(script)]) + script
+    return serialized + bytes(4)
+
+
+def _test():
+    tx_dict = _test_event()['data'][0]
     tx = TxBitsocket(tx_dict)
     assert tx.tx_hash() == 'a685412fca8392e13a44a286464b82db925974c529abb78f201b7c8af179b8b2'
     outputs = list(tx.outputs())
@@ -141,6 +298,27 @@ def _test():
     assert outputs[0].address().cash_address() == 'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l'
     assert outputs[1].amount() == 1_055_736
     assert outputs[1].address().cash_address() == 'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4'
+    assert outputs[1].raw_address() == 'qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4'
+    assert not hasattr(outputs[1], '__dict__')
+
+    raw_tx = TxRaw(bytes.fromhex(_test_raw_tx()))
+    assert raw_tx.tx_hash() == tx.tx_hash()
+    raw_outputs = list(raw_tx.outputs())
+    assert [output.amount() for output in raw_outputs] == [output.amount() for output in outputs]
+    assert [output.raw_address() for output in raw_outputs] == [output.raw_address() for output in outputs]
+    assert [output.address_key() for output in raw_outputs] == [output.address_key() for output in outputs]
+    assert raw_outputs[0].address().cash_address() == 'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l'
+    assert not hasattr(raw_outputs[1], '__dict__')
+
+    op_return = _build_raw_tx([(0, b'\x6a\x04test'), (600, b'\x76\xa9\x14' + bytes(20) + b'\x88\xac')])
+    assert [(output.amount(), output.address_key()) for output in TxRaw(op_return).outputs()] == [
+        (0, None), (600, bytes(21)),
+    ]
+
+    op_return_dict = {'tx': {'h': '00' * 32}, 'out': [{'i': 0, 'e': {'v': 0, 'i': 0}}]}
+    txs = [tx, TxRaw(op_return), TxBitsocket(op_return_dict), raw_tx]
+    assert block_outputs(txs) == [[tx_, output.address_key(), output.amount()]
+                                  for tx_ in txs for output in tx_.outputs()]
 
 
 if __name__ == '__main__':
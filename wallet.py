@@ -1,26 +1,51 @@
 import asyncio
 import base64
 import json
-import traceback
+import logging
+import struct
+import time
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import Dict, Iterable, List, Set
 
 import aiostream
 from aiohttp_sse_client import client as sse_client
-from cashaddress.convert import Address
+
+import address_registry
+import metrics
+import recording
+from tx_event import TxRaw
+
+logger = logging.getLogger(__name__)
+sse_connects = metrics.counter('notifybch_sse_connects_total', 'Bitsocket SSE connection attempts.')
+sse_reconnects = metrics.counter('notifybch_sse_reconnects_total',
+                                 'Bitsocket SSE reconnects after an error or a dropped stream.')
+new_address_restarts = metrics.counter('notifybch_new_address_restarts_total',
+                                       'Bitsocket SSE shard restarts caused by NewAddressException.')
+rawtx_gaps = metrics.counter('notifybch_rawtx_gaps_total', 'Gaps in the sequence numbers of the raw tx feed.')
+
+# raw tx feed frame, modelled on a node's zmq rawtx messages: uint32 length, serialized tx, uint32 sequence
+_RAWTX_LENGTH = struct.Struct('<I')
+_RAWTX_SEQUENCE = struct.Struct('<I')
 
 
 class Wallet(metaclass=ABCMeta):
+    """Addresses are given as address_registry keys."""
+
+    @abstractmethod
+    def add_address_keys(self, keys: Iterable[bytes]) -> None:
+        pass
+
     @abstractmethod
-    def add_addresses(self, addresses: List[Address]) -> None:
+    def remove_address_keys(self, keys: Iterable[bytes]) -> None:
         pass
 
     @abstractmethod
-    def remove_address(self, address: Address) -> None:
+    def is_listening_to_key(self, key: bytes) -> bool:
         pass
 
     @abstractmethod
-    def is_listening_to_address(self, address: Address) -> bool:
+    def listening_keys(self, keys: Set[bytes]) -> Set[bytes]:
+        """The subset of keys listened to, for matching many outputs at once."""
         pass
 
     @abstractmethod
@@ -28,67 +53,395 @@ class Wallet(metaclass=ABCMeta):
         pass
 
 
+class _Shard:
+    def __init__(self, shard_id: int) -> None:
+        self.shard_id = shard_id
+        self.addresses: List[bytes] = []
+        self.restart_future: asyncio.Future = None
+        self.task: asyncio.Future = None
+
+
 class WalletDefault(Wallet):
-    def __init__(self) -> None:
-        self._listening_addresses = set()
-        self._new_address_future: asyncio.Future = None
+    BITSOCKET_URL = 'https://bitsocket.fountainhead.cash/s/'
 
-    def add_addresses(self, addresses: List[Address]) -> None:
-        self._listening_addresses.update({self.base_addr(address)
-                                          for address in addresses})
-        if self._new_address_future is not None:
-            try:
-                self._new_address_future.set_exception(NewAddressException())
-            except:
-                pass
+    def __init__(self, bitsocket_url: str = BITSOCKET_URL, max_addresses_per_shard: int = 500,
+                 restart_delay: float = 0.5, reconnect_delay: float = 1.0,
+                 max_queue_size: int = 1000, record_path: str = None) -> None:
+        self._bitsocket_url = bitsocket_url
+        self._recorder = recording.SseRecorder(record_path) if record_path is not None else None
+        self._max_addresses_per_shard = max_addresses_per_shard
+        self._restart_delay = restart_delay
+        self._reconnect_delay = reconnect_delay
+        self._max_queue_size = max_queue_size
+        self._listening_addresses: Dict[bytes, _Shard] = {}
+        self._shards: List[_Shard] = []
+        # shards before this index are full, so filling a large registry stays linear
+        self._first_open_shard = 0
+        self._dirty_shards: Set[_Shard] = set()
+        self._restart_handle: asyncio.Handle = None
+        self._messages: asyncio.Queue = None
 
-    def base_addr(self, address: Address) -> str:
-        return address.cash_address().split(':')[1]
+    def add_address_keys(self, keys: Iterable[bytes]) -> None:
+        for key in keys:
+            if key is None or key in self._listening_addresses:
+                continue
+            shard = self._shard_with_room()
+            shard.addresses.append(key)
+            self._listening_addresses[key] = shard
+            if self._messages is not None and shard.task is None:
+                self._start_shard(shard)
+            else:
+                self._dirty_shards.add(shard)
+        if self._dirty_shards and self._restart_handle is None and self._messages is not None:
+            self._restart_handle = asyncio.get_event_loop().call_later(self._restart_delay,
+                                                                       self._restart_dirty_shards)
 
-    def remove_address(self, address: Address) -> None:
-        try:
-            self._listening_addresses.remove(address)
-        except ValueError:
-            pass
+    def _shard_with_room(self) -> _Shard:
+        while self._first_open_shard < len(self._shards):
+            shard = self._shards[self._first_open_shard]
+            if len(shard.addresses) < self._max_addresses_per_shard:
+                return shard
+            self._first_open_shard += 1
+        shard = _Shard(len(self._shards))
+        self._shards.append(shard)
+        return shard
+
+    def _restart_dirty_shards(self) -> None:
+        self._restart_handle = None
+        for shard in self._dirty_shards:
+            if shard.restart_future is not None and not shard.restart_future.done():
+                shard.restart_future.set_exception(NewAddressException())
+        self._dirty_shards.clear()
+
+    def remove_address_keys(self, keys: Iterable[bytes]) -> None:
+        removed = {}
+        for key in keys:
+            shard = self._listening_addresses.pop(key, None)
+            if shard is not None:
+                removed.setdefault(shard, set()).add(key)
+        for shard, shard_keys in removed.items():
+            shard.addresses = [key for key in shard.addresses if key not in shard_keys]
+            self._first_open_shard = min(self._first_open_shard, shard.shard_id)
+            self._dirty_shards.add(shard)
+        if self._dirty_shards and self._restart_handle is None and self._messages is not None:
+            self._restart_handle = asyncio.get_event_loop().call_later(self._restart_delay,
+                                                                       self._restart_dirty_shards)
+
+    def is_listening_to_key(self, key: bytes) -> bool:
+        return key in self._listening_addresses
 
-    def is_listening_to_address(self, address: Address) -> bool:
-        return self.base_addr(address) in self._listening_addresses 
+    def listening_keys(self, keys: Set[bytes]) -> Set[bytes]:
+        listening = self._listening_addresses
+        return {key for key in keys if key in listening}
+
+    def address_count(self) -> int:
+        return len(self._listening_addresses)
+
+    def shard_count(self) -> int:
+        return len(self._shards)
 
     async def listen(self):
+        self._messages = asyncio.Queue(maxsize=self._max_queue_size)
+        for shard in self._shards:
+            self._start_shard(shard)
+        self._dirty_shards.clear()
+        try:
+            while True:
+                yield await self._messages.get()
+        finally:
+            for shard in self._shards:
+                if shard.task is not None:
+                    shard.task.cancel()
+                    shard.task = None
+            self._messages = None
+
+    def _start_shard(self, shard: _Shard) -> None:
+        shard.task = asyncio.ensure_future(self._listen_shard(shard))
+
+    async def _listen_shard(self, shard: _Shard) -> None:
         while True:
             query = {
                 "v": 3, "q": {
                     "find": {
                         "out.e.a": {
-                            "$in": list(self._listening_addresses)
+                            "$in": [address_registry.raw_address(key) for key in shard.addresses]
                         },
                     },
                 },
             }
-            print('listen to', query, self._listening_addresses)
+            logger.info('listen to shard %d with %d addresses', shard.shard_id, len(shard.addresses))
             encoded = base64.b64encode(json.dumps(query).encode()).decode()
-            self._new_address_future = asyncio.get_event_loop().create_future()
-            async with sse_client.EventSource(f'https://bitsocket.fountainhead.cash/s/{encoded}') as sock:
-                print('connected.')
-                try:
+            shard.restart_future = asyncio.get_event_loop().create_future()
+            sse_connects.inc()
+            try:
+                async with sse_client.EventSource(f'{self._bitsocket_url}{encoded}') as sock:
+                    logger.info('connected shard %d', shard.shard_id)
                     async for message in aiostream.stream.merge(
                             sock,
-                            aiostream.stream.just(self._new_address_future),
+                            aiostream.stream.just(shard.restart_future),
                     ):
                         message_dict = json.loads(message.data)
-                        print(message_dict)
                         if message_dict['type'] == 'open':
                             continue
-                        yield message_dict
-                except NewAddressException:
-                    self._new_address_future = asyncio.get_event_loop().create_future()
-                except Exception:
-                    traceback.print_exc()
-                    self._new_address_future = asyncio.get_event_loop().create_future()
-                except KeyboardInterrupt:
-                    return
+                        if self._recorder is not None:
+                            self._recorder.record(message.data)
+                        await self._messages.put(message_dict)
+                sse_reconnects.inc()
+            except NewAddressException:
+                new_address_restarts.inc()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('bitsocket shard %d failed', shard.shard_id)
+                sse_reconnects.inc()
+                await asyncio.sleep(self._reconnect_delay)
+
+
+class _WalletKeySet(Wallet):
+    """Wallet that receives every tx whatever it listens to, so its addresses are a plain set."""
+
+    def __init__(self) -> None:
+        self._listening_addresses: Set[bytes] = set()
+
+    def add_address_keys(self, keys: Iterable[bytes]) -> None:
+        self._listening_addresses.update(keys)
+        self._listening_addresses.discard(None)
+
+    def remove_address_keys(self, keys: Iterable[bytes]) -> None:
+        self._listening_addresses.difference_update(keys)
+
+    def is_listening_to_key(self, key: bytes) -> bool:
+        return key in self._listening_addresses
+
+    def listening_keys(self, keys: Set[bytes]) -> Set[bytes]:
+        return keys & self._listening_addresses
+
+    def address_count(self) -> int:
+        return len(self._listening_addresses)
+
+
+class WalletReplay(_WalletKeySet):
+    def __init__(self, path: str, realtime: bool = True, speed: float = 1.0, yield_every: int = 100) -> None:
+        super().__init__()
+        self._path = path
+        self._realtime = realtime
+        self._speed = speed
+        self._yield_every = yield_every
+
+    async def listen(self):
+        replay_started = time.time()
+        first_timestamp = None
+        for i, (timestamp, data) in enumerate(recording.read_records(self._path)):
+            if self._realtime:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) / self._speed - (time.time() - replay_started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif i % self._yield_every == 0:
+                await asyncio.sleep(0)
+            yield json.loads(data)
+
+
+class WalletRawTx(_WalletKeySet):
+    """
+    Listens to a local node's raw tx feed instead of Bitsocket. The node sends every mempool tx,
+    so there is nothing to subscribe to; matching happens on the parsed outputs.
+    """
+
+    def __init__(self, host: str, port: int, reconnect_delay: float = 1.0) -> None:
+        super().__init__()
+        self._host = host
+        self._port = port
+        self._reconnect_delay = reconnect_delay
+
+    async def listen(self):
+        while True:
+            expected_sequence = None
+            try:
+                reader, writer = await asyncio.open_connection(self._host, self._port)
+                logger.info('connected to raw tx feed at %s:%d', self._host, self._port)
+                try:
+                    while True:
+                        length, = _RAWTX_LENGTH.unpack(await reader.readexactly(_RAWTX_LENGTH.size))
+                        data = await reader.readexactly(length + _RAWTX_SEQUENCE.size)
+                        sequence, = _RAWTX_SEQUENCE.unpack_from(data, length)
+                        if expected_sequence is not None and sequence != expected_sequence:
+                            rawtx_gaps.inc()
+                            logger.warning('raw tx feed skipped from %d to %d', expected_sequence, sequence)
+                        expected_sequence = (sequence + 1) & 0xffffffff
+                        yield {'type': 'mempool', 'data': [TxRaw(memoryview(data)[:length])]}
+                finally:
+                    writer.close()
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.IncompleteReadError):
+                logger.exception('raw tx feed at %s:%d failed', self._host, self._port)
+                await asyncio.sleep(self._reconnect_delay)
+
+
+class RawTxPublisher:
+    """Stand-in for a node's raw tx feed, for tests and benchmarks."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self._host = host
+        self._port = port
+        self._server: asyncio.AbstractServer = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._sequence = 0
+        self._connected = asyncio.Event()
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._accept, self._host, self._port)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        self._connected.set()
+        await reader.read()
+        self._writers.discard(writer)
+
+    async def wait_for_subscriber(self) -> None:
+        await self._connected.wait()
+
+    async def publish(self, raw_tx: bytes) -> None:
+        frame = _RAWTX_LENGTH.pack(len(raw_tx)) + raw_tx + _RAWTX_SEQUENCE.pack(self._sequence)
+        self._sequence = (self._sequence + 1) & 0xffffffff
+        for writer in list(self._writers):
+            writer.write(frame)
+            await writer.drain()
+
+    async def close(self) -> None:
+        for writer in self._writers:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
 
 
 class NewAddressException(Exception):
     pass
 
+
+def _test():
+    from aiohttp import web
+
+    addresses = [
+        'bitcoincash:qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4',
+        'bitcoincash:pqhysjvvw7r3grxev3gq5ew3m806wthdd5lqpmma3l',
+        'bitcoincash:qraqx7hu9g8pduxktlfgyzdnma6nmkaxwsehstwwst',
+        'bitcoincash:qr8392rx2n5gm7q26gdqandrn5vdsa8yuqq8x7aw6k',
+    ]
+
+    async def run():
+        connections = []
+        done = asyncio.Event()
+
+        async def handle(request):
+            query = json.loads(base64.b64decode(request.match_info['query']))
+            base_addrs = query['q']['find']['out.e.a']['$in']
+            connections.append(sorted(base_addrs))
+            resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await resp.prepare(request)
+            await resp.write(b'data: {"type": "open", "data": []}\n\n')
+            for base_addr in base_addrs:
+                event = {'type': 'mempool', 'data': [{'out': [{'e': {'a': base_addr, 'v': 1}}]}]}
+                await resp.write(f'data: {json.dumps(event)}\n\n'.encode())
+            await done.wait()
+            return resp
+
+        app = web.Application()
+        app.add_routes([web.get('/s/{query:.*}', handle)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        wallet = WalletDefault(f'http://127.0.0.1:{port}/s/', max_addresses_per_shard=2, restart_delay=0.05)
+        wallet.add_address_keys(address_registry.address_key(address) for address in addresses[:3])
+        assert wallet.shard_count() == 2
+        messages = wallet.listen()
+
+        async def received_addresses(n):
+            return sorted([(await messages.__anext__())['data'][0]['out'][0]['e']['a'] for _ in range(n)])
+
+        assert await asyncio.wait_for(received_addresses(3), 5) == sorted(a.split(':')[1] for a in addresses[:3])
+        assert len(connections) == 2
+
+        wallet.add_address_keys([address_registry.address_key(addresses[3])])
+        assert wallet.shard_count() == 2
+        assert await asyncio.wait_for(received_addresses(2), 5) == sorted(a.split(':')[1] for a in addresses[2:])
+        assert len(connections) == 3
+        assert connections[-1] == sorted(a.split(':')[1] for a in addresses[2:])
+        assert wallet.is_listening_to_key(address_registry.address_key(addresses[3]))
+
+        wallet.remove_address_keys([address_registry.address_key(addresses[2])])
+        assert not wallet.is_listening_to_key(address_registry.address_key(addresses[2]))
+        assert await asyncio.wait_for(received_addresses(1), 5) == [addresses[3].split(':')[1]]
+        assert connections[-1] == [addresses[3].split(':')[1]]
+        assert wallet.address_count() == 3
+        keys = {address_registry.address_key(address) for address in addresses}
+        assert wallet.listening_keys(keys | {bytes(21)}) == keys - {address_registry.address_key(addresses[2])}
+
+        await messages.aclose()
+        done.set()
+        await runner.cleanup()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    _test_replay()
+    _test_raw_tx()
+
+
+def _test_replay():
+    import os
+    import tempfile
+
+    async def run(path):
+        recorder = recording.SseRecorder(path)
+        recorder.record('{"type": "mempool", "data": [1]}', timestamp=100.0)
+        recorder.record('{"type": "mempool", "data": [2]}', timestamp=100.2)
+        recorder.close()
+
+        replay = WalletReplay(path, realtime=False)
+        assert [message['data'] async for message in replay.listen()] == [[1], [2]]
+
+        replay = WalletReplay(path, realtime=True, speed=2.0)
+        started = time.time()
+        assert [message['data'] async for message in replay.listen()] == [[1], [2]]
+        assert 0.09 <= time.time() - started < 0.5
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.get_event_loop().run_until_complete(run(os.path.join(tmp_dir, 'capture.sse')))
+
+
+def _test_raw_tx():
+    import tx_event
+
+    async def run():
+        publisher = RawTxPublisher()
+        await publisher.start()
+        wallet = WalletRawTx('127.0.0.1', publisher.port)
+        wallet.add_address_keys([address_registry.raw_key('qz4v8lrnv786e42n7xg0czpelp439aytusray7cnh4')])
+        messages = wallet.listen()
+        first = asyncio.ensure_future(messages.__anext__())
+        await asyncio.wait_for(publisher.wait_for_subscriber(), 5)
+        await publisher.publish(bytes.fromhex(tx_event._test_raw_tx()))
+        await publisher.publish(tx_event._build_raw_tx([(600, b'\x6a')], tx_id=1))
+
+        tx = (await asyncio.wait_for(first, 5))['data'][0]
+        assert tx.tx_hash() == 'a685412fca8392e13a44a286464b82db925974c529abb78f201b7c8af179b8b2'
+        assert [wallet.is_listening_to_key(output.address_key()) for output in tx.outputs()] == [False, True]
+        tx = (await asyncio.wait_for(messages.__anext__(), 5))['data'][0]
+        assert [output.amount() for output in tx.outputs()] == [600]
+
+        await messages.aclose()
+        await publisher.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    _test()